@@ -2,64 +2,676 @@
 import sys
 import json
 import os
-from xml.etree import ElementTree as ET
-from pylibdmtx.pylibdmtx import encode as dmtx_encode
-from PIL import Image
-import svgwrite
-from reportlab.graphics import renderPDF
-from reportlab.pdfgen import canvas
-from svglib.svglib import svg2rlg
+import copy
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, namedtuple
+import importlib
+import functools
+from lxml import etree as ET
 import base64
-import requests
-import barcode
-from barcode.writer import ImageWriter
 from io import BytesIO
-import boto3
 import re
+import math
+import hashlib
+import hmac
+import pickle
+import zlib
+import weakref
+import contextvars
+from contextlib import contextmanager
+from cache import LRUCache, DiskCache, TieredCache
+from metrics import stage, count, collect_metrics, emit_metrics, submit_in_context
 
-def download_from_s3(s3_path, local_path):
-    s3 = boto3.client('s3')
+# Number of compiled templates kept in memory between warm invocations
+TEMPLATE_CACHE_SIZE = int(os.environ.get("TEMPLATE_CACHE_SIZE", 8))
+# Static/dynamic splits kept per template, one per distinct set of dynamic slot ids
+TEMPLATE_LAYER_CACHE_SIZE = int(os.environ.get("TEMPLATE_LAYER_CACHE_SIZE", 8))
+
+# Default barcode output, "vector" or "png"; each barcode entry can override it with "format"
+BARCODE_FORMAT = os.environ.get("BARCODE_FORMAT", "vector")
+
+# python-barcode's Code128 layout in mm (codex MIN_SIZE / MIN_QUIET_ZONE, writer margins)
+BARCODE_MODULE_WIDTH = 0.2
+BARCODE_QUIET_ZONE = 2.54
+BARCODE_MARGIN = 1.0
+BARCODE_BAR_HEIGHT = 15.0
+BARCODE_PNG_OPTIONS = {'write_text': False}
+
+# Size limit in bytes of the in-process cache of generated barcodes and Data Matrix codes
+SYMBOL_CACHE_BYTES = int(os.environ.get("SYMBOL_CACHE_BYTES", 16 * 1024 * 1024))
+
+SVG_TEXT = '{http://www.w3.org/2000/svg}text'
+SVG_TSPAN = '{http://www.w3.org/2000/svg}tspan'
+SVG_IMAGE = '{http://www.w3.org/2000/svg}image'
+# Non-rendering elements that both layers of a split template need to keep
+SVG_DEFINITIONS = {f'{{http://www.w3.org/2000/svg}}{tag}' for tag in (
+    'defs', 'style', 'symbol', 'clipPath', 'mask', 'pattern', 'marker',
+    'linearGradient', 'radialGradient', 'filter')}
+
+# Parallel downloads of templates and images, and the per-request timeout in seconds
+ASSET_FETCH_WORKERS = int(os.environ.get("ASSET_FETCH_WORKERS", 8))
+ASSET_FETCH_TIMEOUT = float(os.environ.get("ASSET_FETCH_TIMEOUT", 10))
+
+# Downloaded and slot-resized images: cache location and size limits in bytes
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "/tmp/image_cache")
+IMAGE_CACHE_DISK_BYTES = int(os.environ.get("IMAGE_CACHE_DISK_BYTES", 256 * 1024 * 1024))
+IMAGE_CACHE_MEMORY_BYTES = int(os.environ.get("IMAGE_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+# Resolution images are downsampled to for their slot, 0 keeps the original pixels
+IMAGE_TARGET_DPI = int(os.environ.get("IMAGE_TARGET_DPI", 300))
+
+# Worker processes for symbol encoding and batch renders, 0 keeps everything in-process.
+# Meant for hosts outside Lambda, where multiprocessing primitives are not available.
+RENDER_PROCESSES = int(os.environ.get("RENDER_PROCESSES", 0))
+
+# Skip rendering when the output in S3 already carries the fingerprint of the same inputs,
+# and keep recently rendered PDFs in memory by fingerprint (size limit in bytes)
+RENDER_DEDUP = os.environ.get("RENDER_DEDUP", "1") != "0"
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", 32 * 1024 * 1024))
+# Bump whenever a code change alters the outputs (PDF or printer), so ones rendered before it are rebuilt
+RENDER_REVISION = "4"
+# Event fields that do not change the rendered PDF
+FINGERPRINT_IGNORED_FIELDS = {"include_metrics", "debug", "force_render", "batch_output", "output_name"}
+FINGERPRINT_METADATA = "render-fingerprint"
+
+# "batch_output" of a batch event, "files" when not given
+BATCH_OUTPUTS = ("files", "pages", "stream", "sheet")
+# "batch_output": "stream" uploads the document in parts of this many bytes while it renders
+STREAM_PART_BYTES = int(os.environ.get("STREAM_PART_BYTES", 8 * 1024 * 1024))
+
+# Batch records go through check, fetch, render and upload stages that work at the same time
+# on different records. Records waiting between two stages, and threads of each I/O stage.
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", 2))
+PIPELINE_IO_WORKERS = int(os.environ.get("PIPELINE_IO_WORKERS", 4))
+
+# "output_format" -> (file extension, content type, name in responses). zpl and raster are
+# sent to thermal printers as is, rendered at "printer_dpi" dots per inch
+OUTPUT_FORMATS = {
+    "pdf": ("pdf", "application/pdf", "PDF"),
+    "zpl": ("zpl", "text/plain", "ZPL"),
+    "raster": ("pbm", "image/x-portable-bitmap", "Raster"),
+}
+PRINTER_DPI = int(os.environ.get("PRINTER_DPI", 203))
+
+# PDF images are stored once per document as shared XObjects, downsampled to IMAGE_TARGET_DPI
+# at their size on the page, and photos are JPEG encoded at this quality when that is smaller.
+# Encoded images are kept across renders (size limit in bytes).
+PDF_JPEG_QUALITY = int(os.environ.get("PDF_JPEG_QUALITY", 85))
+PDF_IMAGE_CACHE_BYTES = int(os.environ.get("PDF_IMAGE_CACHE_BYTES", 32 * 1024 * 1024))
+# Per-label PDF size limit in bytes ("pdf_byte_budget" in the event), 0 for none. Labels over
+# it are rendered again with images at each (dpi, JPEG quality) in turn until one fits.
+PDF_BYTE_BUDGET = int(os.environ.get("PDF_BYTE_BUDGET", 0))
+PDF_BUDGET_STEPS = [(200, 75), (150, 60), (100, 45), (72, 30)]
+
+# Heavy modules are imported by the first code path that needs them, so a cold start only
+# pays for what the invocation uses: numpy and pylibdmtx for Data Matrix codes, python-barcode
+# for barcodes, PIL for images, requests for URLs, boto3 for S3, reportlab and svglib to render.
+# preload_modules() imports them all up front, e.g. before forking server workers.
+LAZY_MODULES = [
+    "numpy", "pylibdmtx.pylibdmtx", "barcode", "barcode.writer", "PIL.Image", "requests",
+    "boto3", "reportlab.graphics.renderPDF", "reportlab.pdfgen.canvas", "svglib.svglib", "renderer", "printer",
+]
+
+_symbol_cache = LRUCache(SYMBOL_CACHE_BYTES)
+_result_cache = LRUCache(RESULT_CACHE_BYTES)
+_pdf_image_cache = LRUCache(PDF_IMAGE_CACHE_BYTES)
+_process_pool = None
+_s3_client = None
+_image_cache = None
+_http_session = None
+_fetch_executor = None
+_client_lock = threading.Lock()
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+# One lock per template path, so records that miss the cache together load it only once
+_template_load_locks = {}
+# Template background -> {(output_format, dpi): converted background}, dropped with the layers
+_printer_backgrounds = weakref.WeakKeyDictionary()
+_printer_backgrounds_lock = threading.Lock()
+# Versions of the template and images looked up during the current request (see remember_versions)
+_source_versions = contextvars.ContextVar("source_versions", default=None)
+
+def preload_modules():
+    for module_name in LAZY_MODULES:
+        importlib.import_module(module_name)
+
+def get_s3_client():
+    # boto3 clients are thread safe and expensive to create, share one per process
+    global _s3_client
+    with _client_lock:
+        if _s3_client is None:
+            import boto3
+            _s3_client = boto3.client('s3')
+    return _s3_client
+
+def get_http_session():
+    # Pooled keep-alive connections, sized for the fetch executor
+    global _http_session
+    with _client_lock:
+        if _http_session is None:
+            import requests
+            import requests.adapters
+            _http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=ASSET_FETCH_WORKERS,
+                                                    pool_maxsize=ASSET_FETCH_WORKERS)
+            _http_session.mount("http://", adapter)
+            _http_session.mount("https://", adapter)
+    return _http_session
+
+def warm_worker():
+    # Runs once in every pool worker: load the heavy imports and encode throwaway
+    # symbols so libdmtx and the PIL plugins are initialised too
+    preload_modules()
+    generate_data_matrix_svg("0")
+    generate_barcode_png("0")
+
+def get_process_pool():
+    # Spawned rather than forked, so workers never inherit S3 clients, threads or held locks
+    global _process_pool
+    if RENDER_PROCESSES <= 0:
+        return None
+    with _client_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES, initializer=warm_worker,
+                                                mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+def get_image_cache():
+    global _image_cache
+    with _client_lock:
+        if _image_cache is None:
+            _image_cache = TieredCache(LRUCache(IMAGE_CACHE_MEMORY_BYTES),
+                                       DiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_DISK_BYTES))
+    return _image_cache
+
+def get_fetch_executor():
+    global _fetch_executor
+    with _client_lock:
+        if _fetch_executor is None:
+            _fetch_executor = ThreadPoolExecutor(max_workers=ASSET_FETCH_WORKERS, thread_name_prefix="fetch")
+    return _fetch_executor
+
+def split_s3_path(s3_path):
     bucket_name, key = s3_path.replace("s3://", "").split("/", 1)
-    s3.download_file(bucket_name, key, local_path)
+    return bucket_name, key
+
+def download_from_s3(s3_path, local_path):
+    bucket_name, key = split_s3_path(s3_path)
+    get_s3_client().download_file(bucket_name, key, local_path)
+
+def read_from_s3(s3_path):
+    bucket_name, key = split_s3_path(s3_path)
+    return get_s3_client().get_object(Bucket=bucket_name, Key=key)["Body"].read()
+
+def download_asset(source):
+    # Raw bytes of an s3:// object or an http(s) URL
+    if source.startswith("s3://"):
+        return read_from_s3(source)
+    response = get_http_session().get(source, timeout=ASSET_FETCH_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+@contextmanager
+def remember_versions():
+    # Within a request, the template and each image are looked up once: the fingerprint and
+    # the render both use that version. Pipeline stages and fetch threads run in copies of
+    # the context, which share the same dict.
+    token = _source_versions.set({})
+    try:
+        yield
+    finally:
+        _source_versions.reset(token)
+
+def remembered_version(kind, source, lookup):
+    versions = _source_versions.get()
+    if versions is None:
+        return lookup(source)
+    version = versions.get((kind, source))
+    if version is None:
+        version = versions[(kind, source)] = lookup(source)
+    return version
+
+def asset_cache_key(source):
+    # The image's current version, which keys the download cache and goes into render_fingerprint
+    return remembered_version("asset", source, asset_version)
+
+def asset_version(source):
+    # S3 objects by their ETag; URLs by their ETag or Last-Modified from a HEAD request, or
+    # without either by the hash of the bytes, which are cached under it for the render to use
+    if source.startswith("s3://"):
+        bucket_name, key = split_s3_path(source)
+        with stage("image_head"):
+            etag = get_s3_client().head_object(Bucket=bucket_name, Key=key)["ETag"]
+        return f"{source}#{etag}"
+    with stage("image_head"):
+        response = get_http_session().head(source, timeout=ASSET_FETCH_TIMEOUT, allow_redirects=True)
+    validator = response.ok and (response.headers.get("ETag") or response.headers.get("Last-Modified"))
+    if validator:
+        return f"{source}#{validator}"
+    count("image_unvalidated_download")
+    with stage("image_download"):
+        data = download_asset(source)
+    key = f"{source}#sha256:{hashlib.sha256(data).hexdigest()}"
+    get_image_cache().put(key, data)
+    return key
+
+def fetch_asset(source):
+    cache = get_image_cache()
+    key = asset_cache_key(source)
+    data = cache.get(key)
+    if data is None:
+        count("image_cache_miss")
+        with stage("image_download"):
+            data = download_asset(source)
+        count("bytes_in_images", len(data))
+        cache.put(key, data)
+    else:
+        count("image_cache_hit")
+    return data
+
+def prefetch_assets(template_path, images_list):
+    # Start the template check and every image download together, before any substitution
+    executor = get_fetch_executor()
+    template_future = submit_in_context(executor, get_compiled_template, template_path)
+    sources = dict.fromkeys(str(image["source"]) for image in images_list)
+    futures = {source: submit_in_context(executor, fetch_asset, source) for source in sources}
+    with stage("asset_wait"):
+        return template_future.result(), {source: future.result() for source, future in futures.items()}
+
+class TemplateRasters:
+    # Images embedded in the template, kept once as encoded bytes and decoded on first use.
+    # The tree refers to them as raster:<name>, so clones never copy the base64 text.
+    def __init__(self, encoded=None):
+        self.encoded = encoded or {}
+        self._names = {data: name for name, data in self.encoded.items()}
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def add(self, data):
+        name = self._names.get(data)
+        if name is None:
+            name = self._names[data] = str(len(self.encoded))
+            self.encoded[name] = data
+        return name
+
+    def image(self, name):
+        with self._lock:
+            image = self._images.get(name)
+            if image is None:
+                from renderer import decode_image
+                image = self._images[name] = decode_image(self.encoded[name])
+        return image
+
+    def name_of(self, image):
+        with self._lock:
+            for name, decoded in self._images.items():
+                if decoded is image:
+                    return name
+        return None
+
+class CompiledTemplate:
+    # Parsed SVG template kept in the cache; renders only ever work on clones of it
+    def __init__(self, path, etag, root, rasters=None):
+        self.path = path
+        self.etag = etag
+        self.root = root
+        self.rasters = rasters or TemplateRasters()
+        # Text slots are always treated as dynamic, image slots only when the event targets them
+        self.text_ids = {element.get('id') for element in root.iter(SVG_TEXT, SVG_TSPAN) if element.get('id')}
+        self._layers = OrderedDict()
+        # Held while a background renders, so concurrent records wait for it instead of repeating it
+        self._layers_lock = threading.Lock()
+
+    def clone(self):
+        # Tree copy happens in libxml2, the source SVG is never parsed again
+        root = copy.deepcopy(self.root)
+        return ET.ElementTree(root), root
+
+    def layers(self, dynamic_ids):
+        key = frozenset(dynamic_ids) | self.text_ids
+        with self._layers_lock:
+            layers = self._layers.get(key)
+            if layers is None:
+                count("layer_cache_miss")
+                from renderer import LabelRenderer
+                with stage("background_render"):
+                    background_root, overlay_root = split_static_layer(self.root, key)
+                    background = LabelRenderer(self.path, self.rasters).render(background_root)
+                    layers = TemplateLayers(background, overlay_root, self.rasters)
+                self.add_layers(key, layers)
+            else:
+                count("layer_cache_hit")
+                self._layers.move_to_end(key)
+        return layers
+
+    def add_layers(self, key, layers):
+        self._layers[key] = layers
+        self._layers.move_to_end(key)
+        while len(self._layers) > TEMPLATE_LAYER_CACHE_SIZE:
+            self._layers.popitem(last=False)
+
+    def slot_table(self):
+        # id -> the size and placement of each of its slots, as the renderer will see them
+        table = {}
+        for element_id, slots in build_slot_index(self.root).items():
+            for slot in slots:
+                entry = {'tag': ET.QName(slot.element).localname, 'transform': slot.transform}
+                if slot.element.tag == SVG_IMAGE:
+                    width, height = slot_size_in_points(slot.parent, slot.width or 0, slot.height or 0,
+                                                        slot.transform)
+                    entry['size_pt'] = [round(width, 3), round(height, 3)]
+                table.setdefault(element_id, []).append(entry)
+        return table
+
+class TemplateLayers:
+    # Template split into a pre-rendered static background and the part that changes per label
+    def __init__(self, background, overlay_root, rasters=None):
+        self.background = background
+        self.overlay_root = overlay_root
+        self.rasters = rasters
+
+    def clone(self):
+        root = copy.deepcopy(self.overlay_root)
+        return ET.ElementTree(root), root
+
+def find_first_dynamic_path(root, dynamic_ids):
+    # Child positions from the root down to the first dynamic slot in document order
+    for element in root.iter(SVG_TEXT, SVG_TSPAN, SVG_IMAGE):
+        if element.get('id') in dynamic_ids:
+            path = []
+            while element is not root:
+                parent = element.getparent()
+                path.append(parent.index(element))
+                element = parent
+            return path[::-1]
+    return None
+
+def split_static_layer(root, dynamic_ids):
+    # Everything painted before the first dynamic slot can be rendered once as a background.
+    # Static elements painted after it stay in the overlay so the stacking order is unchanged.
+    background = copy.deepcopy(root)
+    overlay = copy.deepcopy(root)
+    path = find_first_dynamic_path(root, dynamic_ids)
+    if path is None:
+        for child in list(overlay):
+            if child.tag not in SVG_DEFINITIONS:
+                overlay.remove(child)
+        return background, overlay
+
+    background_node, overlay_node = background, overlay
+    for depth, position in enumerate(path):
+        background_children = list(background_node)
+        overlay_children = list(overlay_node)
+        # The slot itself goes to the overlay, its ancestors are split in both layers
+        cut = position if depth == len(path) - 1 else position + 1
+        for child in background_children[cut:]:
+            if child.tag not in SVG_DEFINITIONS:
+                background_node.remove(child)
+        for child in overlay_children[:position]:
+            if child.tag not in SVG_DEFINITIONS:
+                overlay_node.remove(child)
+        background_node = background_children[position]
+        overlay_node = overlay_children[position]
+    return background, overlay
+
+def extract_rasters(root, rasters):
+    # Decode the base64 images once and point their hrefs at the raster table
+    from renderer import XLINK_HREF, DATA_URI, RASTER_SCHEME
+    for element in root.iter(SVG_IMAGE):
+        href = element.get(XLINK_HREF) or ""
+        match = DATA_URI.match(href)
+        if match:
+            element.set(XLINK_HREF, RASTER_SCHEME + rasters.add(base64.b64decode(href[match.end():])))
+
+def compile_svg_template(path, etag, svg_bytes):
+    # huge_tree: Illustrator exports embed raster layers as very long base64 attributes
+    parser = ET.XMLParser(huge_tree=True, remove_blank_text=False)
+    root = ET.fromstring(svg_bytes, parser)
+    rasters = TemplateRasters()
+    extract_rasters(root, rasters)
+    return CompiledTemplate(path, etag, root, rasters)
+
+# Ahead-of-time compiled templates (see compiler.py): this header, an HMAC-SHA256 of the rest,
+# then a zlib compressed pickle of the tree without its rasters, the raster table, the slot
+# table and pre-rendered layers. Unpickling runs code, so artifacts are only loaded when the
+# signature matches TEMPLATE_ARTIFACT_KEY, the secret compiler.py signed them with.
+TEMPLATE_ARTIFACT_MAGIC = b"LABELTPL\x02"
+TEMPLATE_ARTIFACT_KEY = os.environ.get("TEMPLATE_ARTIFACT_KEY", "")
+
+@functools.lru_cache(maxsize=None)
+def renderer_versions():
+    # Package metadata rather than the modules, so checking does not import reportlab
+    from importlib.metadata import version, PackageNotFoundError
+    versions = {'revision': RENDER_REVISION}
+    for package in ("reportlab", "svglib", "python-barcode", "pylibdmtx"):
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+def template_artifact_bytes(compiled):
+    layers = [(sorted(key), layers.background, ET.tostring(layers.overlay_root))
+              for key, layers in compiled._layers.items()]
+    artifact = {
+        'source': compiled.path,
+        'source_etag': compiled.etag,
+        'svg': ET.tostring(compiled.root),
+        'rasters': compiled.rasters.encoded,
+        'slots': compiled.slot_table(),
+        'variables': sorted(compiled.text_ids),
+        'versions': renderer_versions(),
+    }
+    buffer = BytesIO()
+    pickler = pickle.Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+    # Decoded rasters inside the pre-rendered drawings are stored by name, not as pixels
+    pickler.persistent_id = lambda obj: compiled.rasters.name_of(obj) if hasattr(obj, 'getbands') else None
+    pickler.dump(artifact)
+    pickler.dump(layers)
+    body = zlib.compress(buffer.getvalue())
+    return TEMPLATE_ARTIFACT_MAGIC + artifact_signature(body) + body
+
+def artifact_signature(body):
+    if not TEMPLATE_ARTIFACT_KEY:
+        raise ValueError("TEMPLATE_ARTIFACT_KEY is not set, compiled templates cannot be signed or loaded")
+    return hmac.new(TEMPLATE_ARTIFACT_KEY.encode('utf-8'), body, hashlib.sha256).digest()
+
+def load_template_artifact(path, etag, data):
+    start = len(TEMPLATE_ARTIFACT_MAGIC)
+    signature, body = data[start:start + 32], data[start + 32:]
+    # Checked before anything is unpickled
+    if not hmac.compare_digest(signature, artifact_signature(body)):
+        raise ValueError(f"{path} is not a compiled template signed with TEMPLATE_ARTIFACT_KEY")
+    unpickler = pickle.Unpickler(BytesIO(zlib.decompress(body)))
+    artifact = unpickler.load()
+    parser = ET.XMLParser(huge_tree=True, remove_blank_text=False)
+    rasters = TemplateRasters(artifact['rasters'])
+    compiled = CompiledTemplate(path, etag, ET.fromstring(artifact['svg'], parser), rasters)
+    # Drawings pickled by another reportlab/svglib are rebuilt from the tree instead
+    if artifact['versions'] == renderer_versions():
+        unpickler.persistent_load = rasters.image
+        for key, background, overlay_svg in unpickler.load():
+            compiled.add_layers(frozenset(key), TemplateLayers(background, ET.fromstring(overlay_svg, parser), rasters))
+    return compiled
+
+def load_template(path, etag, data):
+    if data.startswith(TEMPLATE_ARTIFACT_MAGIC):
+        return load_template_artifact(path, etag, data)
+    return compile_svg_template(path, etag, data)
+
+def get_template_etag(template_path):
+    return remembered_version("template", template_path, template_etag)
+
+def template_etag(template_path):
+    # Cheap freshness check: S3 HEAD for remote templates, mtime/size for local ones
+    if template_path.startswith("s3://"):
+        bucket_name, key = split_s3_path(template_path)
+        return get_s3_client().head_object(Bucket=bucket_name, Key=key)["ETag"]
+    stat = os.stat(template_path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+def fetch_template_bytes(template_path, etag):
+    # The bytes and the ETag they were read at: an object overwritten since the HEAD is
+    # compiled and cached under its new ETag, not under the one the HEAD saw
+    if template_path.startswith("s3://"):
+        bucket_name, key = split_s3_path(template_path)
+        response = get_s3_client().get_object(Bucket=bucket_name, Key=key)
+        return response["Body"].read(), response["ETag"]
+    with open(template_path, 'rb') as file:
+        return file.read(), etag
+
+def cached_template(template_path, etag):
+    with _template_cache_lock:
+        compiled = _template_cache.get(template_path)
+        if compiled is not None and compiled.etag == etag:
+            _template_cache.move_to_end(template_path)
+            count("template_cache_hit")
+            return compiled
+    return None
+
+def get_compiled_template(template_path):
+    with stage("template_head"):
+        etag = get_template_etag(template_path)
+    compiled = cached_template(template_path, etag)
+    if compiled is not None:
+        return compiled
+
+    with _template_cache_lock:
+        load_lock = _template_load_locks.setdefault(template_path, threading.Lock())
+    with load_lock:
+        # Another thread may have loaded it while this one waited
+        compiled = cached_template(template_path, etag)
+        if compiled is not None:
+            return compiled
+        count("template_cache_miss")
+        with stage("template_fetch"):
+            svg_bytes, etag = fetch_template_bytes(template_path, etag)
+        count("bytes_in_template", len(svg_bytes))
+        with stage("template_parse"):
+            compiled = load_template(template_path, etag, svg_bytes)
+        with _template_cache_lock:
+            _template_cache[template_path] = compiled
+            _template_cache.move_to_end(template_path)
+            while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+                _template_cache.popitem(last=False)
+    return compiled
 
 def load_svg_template(s3_path):
-    local_path = "/tmp/template.svg"
-    download_from_s3(s3_path, local_path)
-    tree = ET.parse(local_path)
-    root = tree.getroot()
-    return tree, root
+    return get_compiled_template(s3_path).clone()
 
 def read_json(json_path):
     with open(json_path, 'r') as file:
         data = json.load(file)
     return data
 
+@functools.lru_cache(maxsize=4096)
+def compile_json_path(path):
+    # 'items.options.0.name' -> ('items', 'options', 0, 'name'), parsed once per distinct path
+    # Handle array indices like 'options.0.name': integer keys are treated as array indices
+    return tuple(int(key) if re.match(r'^\d+$', key) else key for key in path.split('.'))
+
+def step_json_path(data, key):
+    if isinstance(data, list):  # If data is a list, we access by index
+        return data[key]
+    return data.get(key)  # If data is a dict, we access by key
+
 def get_value_from_json_path(data, path):
-    keys = path.split('.')
-    for key in keys:
-        # Handle array indices like 'options.0.name'
-        if re.match(r'^\d+$', key):  # if key is an integer, treat it as an array index
-            key = int(key)
-        if isinstance(data, list):  # If data is a list, we access by index
-            data = data[key]
-        else:  # If data is a dict, we access by key
-            data = data.get(key)
+    for key in compile_json_path(path):
+        data = step_json_path(data, key)
         if data is None:
             return None
     return data
 
-def replace_text_in_svg(root, variables):
-    # This function will now support deep access like 'variables.items.options.0.name'
-    for group in root.iter('{http://www.w3.org/2000/svg}text'):
-        group_id = group.get('id')
-        if group_id:
-            # Handle deep nested IDs in the format 'variables.items.orderItemId' or 'variables.items.options.0.name'
-            value = get_value_from_json_path(variables, group_id)
-            if value:
-                for text_elem in group.findall('{http://www.w3.org/2000/svg}tspan'):
+@functools.lru_cache(maxsize=256)
+def compile_path_trie(paths):
+    # Prefix trie of compiled paths; each node is (children by key, paths that end there)
+    root = ({}, [])
+    for path in paths:
+        node = root
+        for key in compile_json_path(path):
+            node = node[0].setdefault(key, ({}, []))
+        node[1].append(path)
+    return root
+
+def resolve_json_paths(data, paths):
+    # Every path in one walk over data, shared prefixes are looked up once; missing paths are None
+    values = dict.fromkeys(paths)
+    stack = [(compile_path_trie(tuple(sorted(values))), data)]
+    while stack:
+        (children, ending), value = stack.pop()
+        for path in ending:
+            values[path] = value
+        for key, child in children.items():
+            child_value = step_json_path(value, key)
+            if child_value is not None:
+                stack.append((child, child_value))
+    return values
+
+def resolve_label_values(data, index):
+    # Text slot ids are paths into variables, barcode and matrix code "data" fields paths into
+    # the whole event; all of them are resolved together as paths into the event
+    text_paths = {element_id: f"variables.{element_id}" for element_id, slots in index.items()
+                  if any(slot.element.tag != SVG_IMAGE for slot in slots)}
+    code_paths = [entry["data"] for entry in data["barcodes"] + data["matrixcodes"]]
+    values = resolve_json_paths(data, list(text_paths.values()) + code_paths)
+    text_values = {element_id: values[path] for element_id, path in text_paths.items()}
+    return text_values, values
+
+# (template, unresolved paths) combinations already logged by this process
+_reported_missing_paths = set()
+
+def report_missing_paths(template_path, values):
+    # All unresolved paths of a label in one line, once per template and set of paths
+    missing = tuple(path for path, value in values.items() if value is None)
+    if not missing:
+        return
+    count("unresolved_paths", len(missing))
+    key = (template_path, missing)
+    if key not in _reported_missing_paths and len(_reported_missing_paths) < 1024:
+        _reported_missing_paths.add(key)
+        print(f"Unresolved paths for {template_path}: {', '.join(missing)}")
+
+# A replaceable element of the template, captured before any substitution touches it
+Slot = namedtuple('Slot', ['element', 'parent', 'transform', 'width', 'height'])
+
+def build_slot_index(root):
+    # Single pass over the tree: id -> [Slot, ...] for every text, tspan and image with an id.
+    # Templates exported from Illustrator may reuse an id, so each id keeps all of its slots.
+    index = {}
+    for element in root.iter(SVG_TEXT, SVG_TSPAN, SVG_IMAGE):
+        element_id = element.get('id')
+        if element_id:
+            slot = Slot(element, element.getparent(), element.get('transform'),
+                        element.get('width'), element.get('height'))
+            index.setdefault(element_id, []).append(slot)
+    return index
+
+def replace_text_in_svg(root, variables, index=None, values=None):
+    # This function will now support deep access like 'variables.items.options.0.name'.
+    # values, when given, holds the already resolved value of every text slot id.
+    if index is None:
+        index = build_slot_index(root)
+    for element_id, slots in index.items():
+        text_slots = [slot for slot in slots if slot.element.tag != SVG_IMAGE]
+        if not text_slots:
+            continue
+        # Handle deep nested IDs in the format 'variables.items.orderItemId' or 'variables.items.options.0.name'
+        if values is not None:
+            value = values[element_id]
+        else:
+            value = get_value_from_json_path(variables, element_id)
+        if not value:
+            continue
+        for slot in text_slots:
+            if slot.element.tag == SVG_TSPAN:
+                slot.element.text = str(value)
+            else:
+                for text_elem in slot.element.findall(SVG_TSPAN):
                     text_elem.text = str(value)
 
 def download_image_as_base64(url):
+    import requests
     response = requests.get(url)
     image_data = base64.b64encode(response.content).decode('utf-8')
     return f'data:image/png;base64,{image_data}'
@@ -70,27 +682,153 @@ def insert_image_as_base64(parent, group_id, image_data):
             image_elem.set('{http://www.w3.org/1999/xlink}href', image_data)
             return
 
+def find_dark_runs(row):
+    # (start, end) column pairs of consecutive dark modules in a boolean row
+    import numpy as np
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], row, [False])).astype(np.int8)))
+    return list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+
+def data_matrix_module_grid(encoded):
+    # libdmtx renders every module as a block of pixels inside a quiet-zone margin;
+    # collapse that back to one boolean per module
+    import numpy as np
+    pixels = np.frombuffer(encoded.pixels, dtype=np.uint8)
+    pixels = pixels.reshape(encoded.height, encoded.width, encoded.bpp // 8)
+    dark = ~pixels.any(axis=2)
+    rows = np.flatnonzero(dark.any(axis=1))
+    cols = np.flatnonzero(dark.any(axis=0))
+    top, left = rows[0], cols[0]
+    # Every run along the top edge spans whole modules and the alternating timing
+    # pattern guarantees single-module runs, so their gcd is the module size
+    module_size = int(np.gcd.reduce([end - start for start, end in find_dark_runs(dark[top, left:])]))
+    half = module_size // 2
+    grid = dark[top + half:rows[-1] + 1:module_size, left + half:cols[-1] + 1:module_size]
+    return grid, module_size, left, top
+
+def data_matrix_path(grid, module_size, origin_x, origin_y):
+    # Merge horizontal runs of dark modules, then stack identical runs of
+    # consecutive rows into one rectangle each
+    rects = []
+    open_runs = {}
+    for y, row in enumerate(grid):
+        runs = find_dark_runs(row)
+        for run in list(open_runs):
+            if run not in runs:
+                rects.append((run, open_runs.pop(run), y))
+        for run in runs:
+            open_runs.setdefault(run, y)
+    for run, y_start in open_runs.items():
+        rects.append((run, y_start, len(grid)))
+
+    commands = []
+    for (x_start, x_end), y_start, y_end in rects:
+        width = (x_end - x_start) * module_size
+        commands.append(f"M{origin_x + x_start * module_size} {origin_y + y_start * module_size}"
+                        f"h{width}v{(y_end - y_start) * module_size}h{-width}z")
+    return "".join(commands)
+
 def generate_data_matrix_svg(data):
+    from pylibdmtx.pylibdmtx import encode as dmtx_encode
     encoded = dmtx_encode(data.encode('utf-8'))
-    image = Image.frombytes('RGB', (encoded.width, encoded.height), encoded.pixels)
-    dwg = svgwrite.Drawing(size=(image.width, image.height))
-    pixel_size = 1
+    grid, module_size, origin_x, origin_y = data_matrix_module_grid(encoded)
+    path = data_matrix_path(grid, module_size, origin_x, origin_y)
 
-    for y in range(image.height):
-        for x in range(image.width):
-            r, g, b = image.getpixel((x, y))
-            if r == 0 and g == 0 and b == 0:
-                dwg.add(dwg.rect(insert=(x * pixel_size, y * pixel_size), size=(pixel_size, pixel_size), fill='black'))
+    # Same pixel coordinate space as the libdmtx bitmap so slot transforms and scales are unchanged
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{encoded.width}" height="{encoded.height}">'
+            f'<path d="{path}" fill="black"/></svg>')
 
-    return dwg.tostring()
+def generate_barcode_svg(barcode_data):
+    # Bars as a single path, laid out like python-barcode's Code128 PNG (mm units) so the
+    # bars land in the same place once the slot stretches the symbol to its width/height
+    import barcode
+    import numpy as np
+    modules = barcode.get('code128', barcode_data).build()[0]
+    dark = np.frombuffer(modules.encode('ascii'), dtype=np.uint8) == ord('1')
+    width = 2 * BARCODE_QUIET_ZONE + len(modules) * BARCODE_MODULE_WIDTH
+    height = 2 * BARCODE_MARGIN + BARCODE_BAR_HEIGHT
+
+    commands = []
+    for start, end in find_dark_runs(dark):
+        bar_width = (end - start) * BARCODE_MODULE_WIDTH
+        commands.append(f"M{BARCODE_QUIET_ZONE + start * BARCODE_MODULE_WIDTH:g} {BARCODE_MARGIN:g}"
+                        f"h{bar_width:g}v{BARCODE_BAR_HEIGHT:g}h{-bar_width:g}z")
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:g}" height="{height:g}">'
+            f'<path d="{"".join(commands)}" fill="black"/></svg>')
 
 def generate_barcode_png(barcode_data):
     # Generate barcode PNG
+    import barcode
+    from barcode.writer import ImageWriter
     png_buffer = BytesIO()
-    barcode.generate('code128', barcode_data, writer=ImageWriter(), output=png_buffer, writer_options={'write_text': False})
+    barcode.generate('code128', barcode_data, writer=ImageWriter(), output=png_buffer, writer_options=BARCODE_PNG_OPTIONS)
     png_buffer.seek(0)  # Reset buffer position
     return png_buffer.getvalue()
 
+SYMBOL_GENERATORS = {
+    "code128": generate_barcode_svg,
+    "code128-png": generate_barcode_png,
+    "datamatrix": generate_data_matrix_svg,
+}
+
+def symbol_options(symbology):
+    # Everything besides the payload that changes the generated symbol
+    if symbology == "code128":
+        return (BARCODE_MODULE_WIDTH, BARCODE_QUIET_ZONE, BARCODE_MARGIN, BARCODE_BAR_HEIGHT)
+    if symbology == "code128-png":
+        return tuple(sorted(BARCODE_PNG_OPTIONS.items()))
+    return ()
+
+def generate_symbol(symbology, payload):
+    # Symbols are deterministic: identical payloads are encoded once and reused,
+    # across records of a batch and across warm invocations
+    key = (symbology, payload, symbol_options(symbology))
+    symbol = _symbol_cache.get(key)
+    if symbol is None:
+        count("symbol_cache_miss")
+        with stage(f"encode_{symbology}"):
+            symbol = SYMBOL_GENERATORS[symbology](payload)
+        _symbol_cache.put(key, symbol)
+    else:
+        count("symbol_cache_hit")
+    return symbol
+
+def encode_symbol_task(symbology, payload):
+    # Pool worker entry point; SVG markup travels back as UTF-8 bytes
+    symbol = SYMBOL_GENERATORS[symbology](payload)
+    return symbol.encode('utf-8') if isinstance(symbol, str) else symbol
+
+def barcode_symbology(entry):
+    # Vector bars by default, "format": "png" keeps the rasterized barcode
+    return "code128-png" if entry.get("format", BARCODE_FORMAT) == "png" else "code128"
+
+def symbol_requests(data):
+    # (symbology, payload) of every symbol a label needs
+    for entry in data["barcodes"]:
+        value = get_value_from_json_path(data, entry["data"])
+        if value:
+            yield barcode_symbology(entry), str(value)
+    for entry in data["matrixcodes"]:
+        value = get_value_from_json_path(data, entry["data"])
+        if value:
+            yield "datamatrix", str(value)
+
+def warm_symbol_cache(records, pool):
+    # Encode every distinct symbol of a batch that is not cached yet across the pool
+    missing = {}
+    for data in records:
+        try:
+            requests_for_record = list(symbol_requests(data))
+        except Exception:
+            # The record fails later with a proper error when it is rendered
+            continue
+        for symbology, payload in requests_for_record:
+            key = (symbology, payload, symbol_options(symbology))
+            if key not in missing and _symbol_cache.get(key) is None:
+                missing[key] = pool.submit(encode_symbol_task, symbology, payload)
+    for key, future in missing.items():
+        symbol = future.result()
+        _symbol_cache.put(key, symbol if key[0] == "code128-png" else symbol.decode('utf-8'))
+
 def insert_svg_element_with_transform(parent, svg_content, width, height, transform, scale=1.0):
     svg_element = ET.fromstring(svg_content)
     group = ET.Element('{http://www.w3.org/2000/svg}g')
@@ -106,11 +844,83 @@ def insert_svg_element_with_transform(parent, svg_content, width, height, transf
     # In SVG, width and height for groups (`g` elements) aren't directly used
     # Scaling should be done via the transform attribute
     
-    for element in svg_element:
+    # Snapshot the children first, appending moves lxml elements out of svg_element
+    for element in list(svg_element):
         group.append(element)
     
     parent.append(group)
+    return group
+
+
+def insert_svg_element_fitted(parent, svg_content, width, height, transform):
+    # Stretch the symbol into width x height like an <image> would, keeping it vector
+    svg_element = ET.fromstring(svg_content)
+    scale_x = float(width) / float(svg_element.get('width'))
+    scale_y = float(height) / float(svg_element.get('height'))
+
+    group = ET.Element('{http://www.w3.org/2000/svg}g')
+    group.set('transform', f"{transform} scale({scale_x} {scale_y})")
+    for element in list(svg_element):
+        group.append(element)
+    parent.append(group)
+    return group
+
+def transform_scale(transform):
+    # Horizontal and vertical scale factors of an SVG transform list, translations ignored
+    scale_x = scale_y = 1.0
+    for name, arguments in re.findall(r'(\w+)\s*\(([^)]*)\)', transform or ""):
+        values = [float(value) for value in re.split(r'[\s,]+', arguments.strip()) if value]
+        if name == "matrix" and len(values) == 6:
+            scale_x *= math.hypot(values[0], values[1])
+            scale_y *= math.hypot(values[2], values[3])
+        elif name == "scale" and values:
+            scale_x *= values[0]
+            scale_y *= values[1] if len(values) > 1 else values[0]
+    return scale_x, scale_y
+
+def slot_size_in_points(parent, width, height, transform):
+    # Size the slot is drawn at, following the transforms of the slot and its ancestors
+    scale_x, scale_y = transform_scale(transform)
+    for ancestor in [parent] + list(parent.iterancestors()):
+        ancestor_x, ancestor_y = transform_scale(ancestor.get('transform'))
+        scale_x *= ancestor_x
+        scale_y *= ancestor_y
+    return float(width) * scale_x, float(height) * scale_y
+
+def fit_image_to_slot(image_data, width_pt, height_pt, dpi=None):
+    # Downsample to what the slot can show at the target DPI, keeping the aspect ratio.
+    # Results are cached by content hash and pixel size, so repeated products are resized once.
+    dpi = IMAGE_TARGET_DPI if dpi is None else dpi
+    if not dpi:
+        return image_data
+    max_width = max(1, math.ceil(width_pt / 72 * dpi))
+    max_height = max(1, math.ceil(height_pt / 72 * dpi))
+    cache = get_image_cache()
+    key = f"fit:{hashlib.sha256(image_data).hexdigest()}:{max_width}x{max_height}"
+    fitted = cache.get(key)
+    if fitted is not None:
+        count("image_fit_cache_hit")
+        return fitted
+
+    count("image_fit_cache_miss")
+    with stage("image_fit"):
+        fitted = resize_image_data(image_data, max_width, max_height)
+    cache.put(key, fitted)
+    return fitted
 
+def resize_image_data(image_data, max_width, max_height):
+    from PIL import Image
+    image = Image.open(BytesIO(image_data))
+    if image.width <= max_width and image.height <= max_height:
+        fitted = image_data
+    else:
+        if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        image.thumbnail((max_width, max_height), Image.LANCZOS)
+        png_buffer = BytesIO()
+        image.save(png_buffer, format="PNG")
+        fitted = png_buffer.getvalue()
+    return fitted
 
 def insert_png_with_transform(parent, png_data, width, height, transform):
     # Insert PNG image into SVG
@@ -121,25 +931,90 @@ def insert_png_with_transform(parent, png_data, width, height, transform):
     image_elem.set('transform', transform)
     image_elem.set('{http://www.w3.org/1999/xlink}href', f'data:image/png;base64,{png_data_encoded}')
     parent.append(image_elem)
+    return image_elem
 
-def convert_svg_to_pdf(svg_tree, pdf_file_path):
-    temp_svg_path = "/tmp/temp_output.svg"
-    svg_tree.write(temp_svg_path)
-    drawing = svg2rlg(temp_svg_path)
-    
-    # Get the dimensions of the drawing from the SVG
-    width, height = drawing.width, drawing.height
-    
+def pdf_image_optimizer(dpi=IMAGE_TARGET_DPI, jpeg_quality=PDF_JPEG_QUALITY):
+    from renderer import ImageOptimizer
+    return ImageOptimizer(dpi, jpeg_quality, _pdf_image_cache)
+
+def draw_background(c, background, optimizer):
+    # The cached background is drawn as a form XObject, so a document only stores it once
+    from renderer import draw_drawing
+    form_name = f"TemplateBackground{id(background)}"
+    if not c.hasForm(form_name):
+        c.beginForm(form_name, 0, 0, background.width, background.height)
+        draw_drawing(background, c, 0, 0, optimizer)
+        c.endForm()
+    c.doForm(form_name)
+
+def render_svg_drawing(svg_tree, source_path="", rasters=None):
+    # The lxml tree goes straight to svglib's renderer, no temporary SVG file;
+    # source_path only matters for resolving relative external hrefs.
+    from renderer import LabelRenderer
+    with stage("svg_render"):
+        return LabelRenderer(source_path, rasters).render(svg_tree.getroot())
+
+def draw_label(c, drawing, background=None, x=0, y=0, optimizer=None, clip=False):
+    # background is an optional pre-rendered Drawing of the template's static layer. clip keeps
+    # artwork reaching past the label's edges inside it, where a page edge does not cut it off.
+    from renderer import draw_drawing
+    if optimizer is None:
+        optimizer = pdf_image_optimizer()
+    c.saveState()
+    c.translate(x, y)
+    if clip:
+        path = c.beginPath()
+        path.rect(0, 0, drawing.width, drawing.height)
+        c.clipPath(path, stroke=0, fill=0)
+    if background is not None:
+        draw_background(c, background, optimizer)
+    draw_drawing(drawing, c, 0, 0, optimizer)
+    c.restoreState()
+
+def draw_label_page(c, drawing, background=None, optimizer=None):
+    # One label per page, sized to the drawing
+    with stage("pdf_render"):
+        c.setPageSize((drawing.width, drawing.height))
+        # Draw the content at the bottom-left corner
+        draw_label(c, drawing, background, optimizer=optimizer)
+        c.showPage()
+
+def write_label_pdf(pdf_file_path, drawing, background=None, optimizer=None):
     # Create a new canvas with dimensions matching the SVG
-    c = canvas.Canvas(pdf_file_path, pagesize=(width, height))
-    
-    # Draw the content at the bottom-left corner
-    renderPDF.draw(drawing, c, 0, 0)
-    
-    c.showPage()
-    c.save()
+    from renderer import pdf_canvas
+    c = pdf_canvas(pdf_file_path, pagesize=(drawing.width, drawing.height))
+    draw_label_page(c, drawing, background, optimizer)
+    with stage("pdf_save"):
+        c.save()
+
+def convert_svg_to_pdf(svg_tree, pdf_file_path, source_path="", background=None, rasters=None):
+    # pdf_file_path may be a path or a writable file-like object such as BytesIO.
+    drawing = render_svg_drawing(svg_tree, source_path, rasters)
+    write_label_pdf(pdf_file_path, drawing, background)
+
+def render_pdf_bytes(svg_tree, source_path="", background=None, rasters=None, byte_budget=0):
+    drawing = render_svg_drawing(svg_tree, source_path, rasters)
+    steps = [(IMAGE_TARGET_DPI, PDF_JPEG_QUALITY)] + (PDF_BUDGET_STEPS if byte_budget else [])
+    for attempt, (dpi, jpeg_quality) in enumerate(steps):
+        if attempt:
+            count("pdf_budget_retries")
+        optimizer = pdf_image_optimizer(dpi, jpeg_quality)
+        pdf_buffer = BytesIO()
+        write_label_pdf(pdf_buffer, drawing, background, optimizer)
+        # Only the images can be made smaller, a label without any is as small as it gets
+        if not byte_budget or pdf_buffer.tell() <= byte_budget or not optimizer.images_drawn:
+            break
+    if byte_budget and pdf_buffer.tell() > byte_budget:
+        count("pdf_budget_exceeded")
+        print(f"PDF is {pdf_buffer.tell()} bytes, over its budget of {byte_budget} bytes")
+    return pdf_buffer.getvalue()
 
-def replace_image(svg_root, data_image, target, item_id, image_url=None, obj=None):
+def dynamic_slot_ids(data):
+    # Image slots the event replaces with barcodes, matrix codes and images
+    entries = data["barcodes"] + data["matrixcodes"] + data["images"]
+    return {str(entry["id"]) for entry in entries}
+
+def replace_image(svg_root, data_image, target, item_id, image_url=None, obj=None, index=None):
     if obj is None:
         raise ValueError("Object 'obj' must be provided.")
     
@@ -150,80 +1025,100 @@ def replace_image(svg_root, data_image, target, item_id, image_url=None, obj=Non
     offset_top = offset.get("top", 0)
     offset_bottom = offset.get("bottom", 0)
 
-    for parent in svg_root.findall(".//{http://www.w3.org/2000/svg}g"):
-        for img_elem in parent.findall("{http://www.w3.org/2000/svg}image"):
-            img_id = img_elem.get("id")
-            if img_id == item_id:
-                transform = img_elem.get("transform")
-                width = img_elem.get("width")
-                height = img_elem.get("height")
-                parent.remove(img_elem)
-                
-                # Adjust width and height based on scale
-                adjusted_width = str(float(width) * scale)
-                adjusted_height = str(float(height) * scale)
-
-                # Adjust transform based on offset
-                if transform:
-                    transform += f" translate({offset_right}, {offset_down})"
-                else:
-                    transform = f"translate({offset_right}, {offset_down})"
-                
-                # Apply adjustments and insert the new image
-                if target == "datamatrix":
-                    insert_svg_element_with_transform(parent, data_image, adjusted_width, adjusted_height, transform, scale)
-                elif target == "barcode":
-                    insert_png_with_transform(parent, data_image, adjusted_width, adjusted_height, transform)
-                elif target == "image":
-                    if image_url.startswith("s3://"):
-                        local_image_path = "/tmp/temp_image.png"
-                        download_from_s3(image_url, local_image_path)
-                        with open(local_image_path, "rb") as image_file:
-                            png_data = image_file.read()
-                    else:
-                        response = requests.get(image_url)
-                        png_data = response.content
-                    
-                    insert_png_with_transform(parent, png_data, adjusted_width, adjusted_height, transform)
-
-def find_svg_element(data, svg_root, barcode_list, datamatrix_list, images_list):
+    if index is None:
+        index = build_slot_index(svg_root)
+    slots = index.get(item_id, [])
+    image_slots = [slot for slot in slots if slot.element.tag == SVG_IMAGE]
+    # Replaced images leave the tree, drop them so a repeated id is a no-op like before
+    index[item_id] = [slot for slot in slots if slot.element.tag != SVG_IMAGE]
+
+    for img_elem, parent, transform, width, height in image_slots:
+        parent.remove(img_elem)
+        
+        # Adjust width and height based on scale
+        adjusted_width = str(float(width) * scale)
+        adjusted_height = str(float(height) * scale)
+
+        # Adjust transform based on offset
+        if transform:
+            transform += f" translate({offset_right}, {offset_down})"
+        else:
+            transform = f"translate({offset_right}, {offset_down})"
+        
+        # Apply adjustments and insert the new image
+        symbol = None
+        if target == "datamatrix":
+            symbol = insert_svg_element_with_transform(parent, data_image, adjusted_width, adjusted_height, transform, scale)
+        elif target == "barcode":
+            symbol = insert_png_with_transform(parent, data_image, adjusted_width, adjusted_height, transform)
+        elif target == "barcode_svg":
+            symbol = insert_svg_element_fitted(parent, data_image, adjusted_width, adjusted_height, transform)
+        elif target == "image":
+            # data_image holds the prefetched bytes; fetch here only when called without them
+            png_data = data_image if data_image is not None else fetch_asset(image_url)
+            png_data = fit_image_to_slot(png_data, *slot_size_in_points(parent, adjusted_width, adjusted_height, transform))
+            insert_png_with_transform(parent, png_data, adjusted_width, adjusted_height, transform)
+        # Printer output finds symbols by their slot id and sends them as native barcodes
+        if symbol is not None:
+            symbol.set('id', item_id)
+
+def resolve_entry_data(data, entry, values=None):
+    if values is not None:
+        return values[entry["data"]]
+    return get_value_from_json_path(data, entry["data"])
+
+def find_svg_element(data, svg_root, barcode_list, datamatrix_list, images_list, index=None, assets=None, values=None):
     # Find the image tag with the datamatrix ID and replace its content
+    if index is None:
+        index = build_slot_index(svg_root)
 
     #generating Barcode images and replacing into the SVG template
     for barcode in barcode_list:
         # Resolve the actual data value from the JSON path in 'data'
-        barcode_data = get_value_from_json_path(data, barcode["data"])
+        barcode_data = resolve_entry_data(data, barcode, values)
         if barcode_data:  # Ensure the resolved data is valid
-            barcode_png = generate_barcode_png(str(barcode_data))
-            replace_image(svg_root, barcode_png, "barcode", str(barcode["id"]), obj=barcode)
+            if barcode_symbology(barcode) == "code128-png":
+                barcode_png = generate_symbol("code128-png", str(barcode_data))
+                replace_image(svg_root, barcode_png, "barcode", str(barcode["id"]), obj=barcode, index=index)
+            else:
+                barcode_svg = generate_symbol("code128", str(barcode_data))
+                replace_image(svg_root, barcode_svg, "barcode_svg", str(barcode["id"]), obj=barcode, index=index)
 
     #generating Data Matrix images and replacing into the SVG template
     for matrix in datamatrix_list:
         # Resolve the actual data value from the JSON path in 'data'
-        matrix_data = get_value_from_json_path(data, matrix["data"])
+        matrix_data = resolve_entry_data(data, matrix, values)
         if matrix_data:  # Ensure the resolved data is valid
-            matrix_svg = generate_data_matrix_svg(str(matrix_data))
-            replace_image(svg_root, matrix_svg, "datamatrix", str(matrix["id"]), obj=matrix)
+            matrix_svg = generate_symbol("datamatrix", str(matrix_data))
+            replace_image(svg_root, matrix_svg, "datamatrix", str(matrix["id"]), obj=matrix, index=index)
 
 
     #generating Image images and replacing into the SVG template
     for images in images_list:
-        replace_image(svg_root, matrix_svg, "image", str(images["id"]), image_url=images["source"], obj=images)
-
-def lambda_handler(event, context):
-    # Load the JSON data
-    json_path = "/tmp/clean_template.json"
-    with open(json_path, 'w') as f:
-        json.dump(event, f)
-    data = read_json(json_path)
+        image_data = (assets or {}).get(str(images["source"]))
+        replace_image(svg_root, image_data, "image", str(images["id"]), image_url=images["source"], obj=images, index=index)
 
+def prepare_label(data, prefetched=None):
     # Load the SVG template
     template_path = data["template_path"]
-    svg_tree, svg_root = load_svg_template(template_path)
-    
+    # Template freshness check and image downloads run concurrently, unless a pipeline's
+    # fetch stage already did them
+    compiled, assets = prefetched or prefetch_assets(template_path, data["images"])
+    # Only the dynamic part of the template is cloned and rendered per label
+    layers = compiled.layers(dynamic_slot_ids(data))
+    with stage("clone"):
+        svg_tree, svg_root = layers.clone()
+        # One pass over the template; every substitution below looks its slots up here
+        slot_index = build_slot_index(svg_root)
+
+    # Every variable path the label needs, resolved in one walk over the event
+    with stage("resolve"):
+        text_values, values = resolve_label_values(data, slot_index)
+    report_missing_paths(template_path, values)
 
     # Replace text placeholders in the SVG
-    replace_text_in_svg(svg_root, data["variables"])
+    with stage("text"):
+        replace_text_in_svg(svg_root, data["variables"], slot_index, text_values)
     #replace_text_in_svg(svg_root, data["variables"]["item"])
     
     """
@@ -243,7 +1138,8 @@ def lambda_handler(event, context):
     #Barcode image list
     images_list = data["images"]
     #Multiple barcodes/datamatrix images
-    find_svg_element(data, svg_root, barcode_list, datamatrix_list, images_list)
+    with stage("symbols_and_images"):
+        find_svg_element(data, svg_root, barcode_list, datamatrix_list, images_list, slot_index, assets, values)
 
     """
     # Replace matrixcode attributes
@@ -252,20 +1148,553 @@ def lambda_handler(event, context):
         svg_root.set(key, str(value))
     """
 
-    # Convert the final SVG to PDF using orderItemId as the filename
-    order_item_id = str(data["variables"]["item"]["orderItemId"])
-    pdf_file_path = f"/tmp/{order_item_id}.pdf"
-    convert_svg_to_pdf(svg_tree, pdf_file_path)
+    return svg_tree, layers
 
+def render_label(data, prefetched=None):
+    svg_tree, layers = prepare_label(data, prefetched)
+    output_format = label_output_format(data)
+    if output_format != "pdf":
+        return render_printer_bytes(data, svg_tree, layers, output_format)
+    byte_budget = int(data.get("pdf_byte_budget", PDF_BYTE_BUDGET))
+    return render_pdf_bytes(svg_tree, data["template_path"], layers.background, layers.rasters, byte_budget)
+
+def label_output_format(data):
+    output_format = data.get("output_format", "pdf")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output_format '{output_format}', expected one of {', '.join(OUTPUT_FORMATS)}")
+    return output_format
+
+def output_file_name(data, name):
+    return f'{name}.{OUTPUT_FORMATS[label_output_format(data)][0]}'
+
+def render_printer_bytes(data, svg_tree, layers, output_format):
+    # ZPL or a 1-bit raster for thermal printers, no PDF in between. The template background
+    # is converted once per resolution, only the label's own part is converted per render.
+    import printer
+    dpi = int(data.get("printer_dpi", PRINTER_DPI))
+    drawing = render_svg_drawing(svg_tree, data["template_path"], layers.rasters)
+    background = printer_background(layers, output_format, dpi)
+    with stage("printer_render"):
+        if output_format == "zpl":
+            fields = printer.zpl_fields(drawing, dpi, printer_symbols(data))
+            return printer.zpl_label(drawing.width, drawing.height, dpi, [background, fields])
+        return printer.pbm_bytes(printer.rasterize(drawing, dpi, background))
+
+def printer_background(layers, output_format, dpi):
+    import printer
+    key = (output_format, dpi)
+    with _printer_backgrounds_lock:
+        converted = _printer_backgrounds.setdefault(layers.background, {})
+        background = converted.get(key)
+    if background is not None:
+        count("printer_background_hit")
+        return background
+    count("printer_background_miss")
+    with stage("printer_background"):
+        if output_format == "zpl":
+            background = printer.zpl_fields(layers.background, dpi)
+        else:
+            background = printer.rasterize(layers.background, dpi)
+    with _printer_backgrounds_lock:
+        converted[key] = background
+    return background
+
+def printer_symbols(data):
+    # Slot id -> (symbology, payload, module columns and rows) of every barcode and Data Matrix
+    symbols = {}
+    for symbology, entries in (("code128", data["barcodes"]), ("datamatrix", data["matrixcodes"])):
+        for entry in entries:
+            value = get_value_from_json_path(data, entry["data"])
+            if value:
+                symbols[str(entry["id"])] = (symbology, str(value), symbol_modules(symbology, str(value)))
+    return symbols
+
+@functools.lru_cache(maxsize=1024)
+def symbol_modules(symbology, payload):
+    # Native printer symbols are sized in dots per module, so the slot size needs the module count
+    if symbology == "datamatrix":
+        from pylibdmtx.pylibdmtx import encode as dmtx_encode
+        grid = data_matrix_module_grid(dmtx_encode(payload.encode('utf-8')))[0]
+        return grid.shape[1], grid.shape[0]
+    import barcode
+    return len(barcode.get('code128', payload).build()[0]), 1
+
+def render_fingerprint(data):
+    # Content hash of everything that decides the PDF: the event without its delivery options,
+    # the template's ETag, each image's current version, the renderer version and settings
+    with stage("fingerprint"):
+        event = {key: value for key, value in data.items() if key not in FINGERPRINT_IGNORED_FIELDS}
+        sources = list(dict.fromkeys(str(image["source"]) for image in data.get("images", [])))
+        executor = get_fetch_executor()
+        image_keys = [submit_in_context(executor, asset_cache_key, source) for source in sources]
+        inputs = {
+            'event': event,
+            'template': get_template_etag(data["template_path"]),
+            'images': [future.result() for future in image_keys],
+            'renderer': renderer_versions(),
+            'settings': render_settings(),
+        }
+        canonical = json.dumps(inputs, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def render_settings():
+    # Configuration that changes the output; the event's own printer_dpi and pdf_byte_budget
+    # are covered by the event
+    return {
+        'barcode_format': BARCODE_FORMAT,
+        'symbols': {symbology: symbol_options(symbology) for symbology in SYMBOL_GENERATORS},
+        'image_target_dpi': IMAGE_TARGET_DPI,
+        'jpeg_quality': PDF_JPEG_QUALITY,
+        'pdf_byte_budget': PDF_BYTE_BUDGET,
+        'printer_dpi': PRINTER_DPI,
+    }
+
+def label_fingerprint(data):
+    return render_fingerprint(data) if RENDER_DEDUP else None
+
+def output_is_current(data, file_name, fingerprint):
+    # One HEAD request: the output exists and was rendered from the same inputs
+    if fingerprint is None or data.get("force_render"):
+        return False
+    from botocore.exceptions import ClientError
+    try:
+        with stage("output_head"):
+            head = get_s3_client().head_object(Bucket=data["variables"]["bucket"],
+                                               Key=f'{data["output_path"]}/{file_name}')
+    except ClientError:
+        # Missing (or not readable), render it
+        return False
+    current = head.get("Metadata", {}).get(FINGERPRINT_METADATA) == fingerprint
+    count("output_current" if current else "output_stale")
+    return current
+
+def render_label_cached(data, fingerprint=None, prefetched=None):
+    # Replays that land on another output key, or after the object was removed, reuse the PDF
+    if fingerprint is None:
+        return render_label(data, prefetched)
+    pdf_bytes = None if data.get("force_render") else _result_cache.get(fingerprint)
+    if pdf_bytes is None:
+        count("result_cache_miss")
+        pdf_bytes = render_label(data, prefetched)
+        _result_cache.put(fingerprint, pdf_bytes)
+    else:
+        count("result_cache_hit")
+    return pdf_bytes
+
+def upload_pdf(data, file_name, pdf_bytes, fingerprint=None):
     # Upload the PDF to S3 using the bucket name from the JSON data
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
     s3_bucket_name = data["variables"]["bucket"]
     s3_key = data["output_path"]
-    s3.upload_file(pdf_file_path, s3_bucket_name, f'{s3_key}/{order_item_id}.pdf')
+    count("bytes_out", len(pdf_bytes))
+    extra_args = {'ContentType': OUTPUT_FORMATS[label_output_format(data)][1]}
+    if fingerprint is not None:
+        extra_args['Metadata'] = {FINGERPRINT_METADATA: fingerprint}
+    with stage("upload"):
+        s3.upload_fileobj(BytesIO(pdf_bytes), s3_bucket_name, f'{s3_key}/{file_name}', ExtraArgs=extra_args)
+
+def expand_batch_records(event):
+    # Each record is merged over the shared batch fields, variables key by key
+    shared = {key: value for key, value in event.items() if key != "records"}
+    for record in event["records"]:
+        data = {**shared, **record}
+        data["variables"] = {**shared.get("variables", {}), **record.get("variables", {})}
+        yield data
+
+def handle_batch(event):
+    # "records" renders many labels in one invocation. Output is one PDF per record
+    # by default, or a single multi-page PDF with "batch_output": "pages".
+    # A failing record is reported and skipped, the rest of the batch still renders.
+    # Outputs already rendered from the same inputs are listed as unchanged and not rebuilt.
+    rendered = []
+    unchanged = []
+    outputs = []
+    failed = []
+    records = list(expand_batch_records(event))
+
+    # With RENDER_PROCESSES set, symbols (pages) or whole records (files) are fanned out to worker processes
+    pool = get_process_pool()
+
+    batch_output = event.get("batch_output", "files")
+    if batch_output not in BATCH_OUTPUTS:
+        raise ValueError(f"Unknown batch_output '{batch_output}', expected one of {', '.join(BATCH_OUTPUTS)}")
+    output_format = label_output_format(event)
+    if output_format != "pdf" and batch_output in ("stream", "sheet"):
+        raise ValueError(f'"batch_output": "{batch_output}" only writes PDF, not {output_format}')
+    if batch_output == "stream":
+        return stream_batch(event, records)
+    if batch_output == "sheet":
+        return impose_batch(event, records)
+    if batch_output == "pages":
+        file_name = output_file_name(event, event.get("output_name", "batch"))
+        fingerprint = batch_fingerprint(records)
+        if output_is_current(records[0] if records else event, file_name, fingerprint):
+            unchanged = [str(data["variables"]["item"]["orderItemId"]) for data in records]
+            return batch_response(rendered, unchanged, [file_name], failed)
+        if output_format != "pdf":
+            return join_batch(records, file_name, fingerprint)
+
+        if pool is not None:
+            warm_symbol_cache(records, pool)
+        from renderer import pdf_canvas
+        pdf_buffer = BytesIO()
+        c = pdf_canvas(pdf_buffer)
+
+        def draw_page(job):
+            draw_label_page(c, job.drawing, job.layers.background)
+            job.drawing = None
+            return True
+
+        jobs, failed = draw_batch(records, draw_page)
+        rendered = [job.order_item_id for job in jobs]
+        if rendered:
+            c.save()
+            # A document missing failed records must not look current to the retry
+            upload_pdf(records[0], file_name, pdf_buffer.getvalue(), None if failed else fingerprint)
+            outputs.append(file_name)
+    else:
+        # Record N+1 is checked and downloaded while record N renders and N-1 uploads
+        from pipeline import Pipeline, Stage
+        stages = [Stage("check", check_job_output, PIPELINE_IO_WORKERS)]
+        # Worker processes fetch for themselves
+        if pool is None:
+            stages.append(Stage("fetch", fetch_job_assets, PIPELINE_IO_WORKERS))
+        stages += [Stage("render", render_job, RENDER_PROCESSES if pool is not None else 1),
+                   Stage("upload", upload_job, PIPELINE_IO_WORKERS)]
+        jobs, failed = run_jobs(Pipeline(stages, PIPELINE_DEPTH), records)
+        for job in jobs:
+            (unchanged if job.unchanged else rendered).append(job.order_item_id)
+            outputs.append(job.file_name)
+
+    return batch_response(rendered, unchanged, outputs, failed)
+
+class BatchJob:
+    # One record on its way through the batch pipeline stages
+    def __init__(self, data):
+        self.data = data
+        self.order_item_id = None
+        self.file_name = None
+        self.fingerprint = None
+        self.unchanged = False
+        self.prefetched = None
+        self.layers = None
+        self.drawing = None
+        self.output = None
+
+def run_jobs(pipeline, records):
+    # The jobs that made it through every stage, in record order, and the failed records
+    jobs = [BatchJob(data) for data in records]
+    errors = pipeline.run(jobs)
+    failed = [{'index': position, 'error': f"{type(e).__name__}: {e}"} for position, e in sorted(errors.items())]
+    return [job for position, job in enumerate(jobs) if position not in errors], failed
+
+def draw_batch(records, draw):
+    # Records are downloaded and turned into drawings ahead of draw(job), which puts them on
+    # the shared canvas one at a time in record order
+    from pipeline import Pipeline, Stage
+    return run_jobs(Pipeline([
+        Stage("fetch", fetch_job_assets, PIPELINE_IO_WORKERS),
+        Stage("prepare", prepare_job),
+        Stage("draw", draw, ordered=True),
+    ], PIPELINE_DEPTH), records)
+
+def fingerprint_job(job):
+    job.fingerprint = render_fingerprint(job.data)
+    return True
+
+def check_job_output(job):
+    data = job.data
+    job.order_item_id = str(data["variables"]["item"]["orderItemId"])
+    job.fingerprint = label_fingerprint(data)
+    job.file_name = output_file_name(data, job.order_item_id)
+    job.unchanged = output_is_current(data, job.file_name, job.fingerprint)
+    return not job.unchanged
+
+def fetch_job_assets(job):
+    # A PDF still in the result cache needs nothing
+    data = job.data
+    if job.fingerprint is not None and not data.get("force_render") and _result_cache.get(job.fingerprint):
+        return True
+    job.prefetched = prefetch_assets(data["template_path"], data["images"])
+    return True
+
+def prepare_job(job):
+    data = job.data
+    job.order_item_id = str(data["variables"]["item"]["orderItemId"])
+    svg_tree, job.layers = prepare_label(data, job.prefetched)
+    job.prefetched = None
+    job.drawing = render_svg_drawing(svg_tree, data["template_path"], job.layers.rasters)
+    return True
+
+def render_job(job):
+    pool = get_process_pool()
+    if pool is not None:
+        job.output = pool.submit(render_label, job.data).result()
+        if job.fingerprint is not None:
+            _result_cache.put(job.fingerprint, job.output)
+    else:
+        job.output = render_label_cached(job.data, job.fingerprint, job.prefetched)
+    job.prefetched = None
+    return True
+
+def upload_job(job):
+    upload_pdf(job.data, job.file_name, job.output, job.fingerprint)
+    job.output = None
+    return True
+
+def batch_fingerprint(records, layout="pages"):
+    # A multi-page document's fingerprint covers every record, in order
+    if not RENDER_DEDUP or not records:
+        return None
+    # Each record's HEAD requests overlap with the others'
+    from pipeline import Pipeline, Stage
+    jobs, failed = run_jobs(Pipeline([Stage("fingerprint", fingerprint_job, PIPELINE_IO_WORKERS)], PIPELINE_DEPTH), records)
+    if failed:
+        # Failing records are reported by the render
+        return None
+    record_fingerprints = [job.fingerprint for job in jobs]
+    return hashlib.sha256(":".join([layout] + record_fingerprints).encode('utf-8')).hexdigest()
+
+def join_batch(records, file_name, fingerprint):
+    # ZPL labels and PBM images both stay valid when concatenated, so "pages" of printer
+    # output is a single print job holding one label per record
+    rendered = []
+    failed = []
+    labels = []
+    for position, data in enumerate(records):
+        try:
+            order_item_id = str(data["variables"]["item"]["orderItemId"])
+            labels.append(render_label(data))
+        except Exception as e:
+            failed.append({'index': position, 'error': f"{type(e).__name__}: {e}"})
+            continue
+        rendered.append(order_item_id)
+    if rendered:
+        upload_pdf(records[0], file_name, b"".join(labels), None if failed else fingerprint)
+    return batch_response(rendered, [], [file_name] if rendered else [], failed)
+
+def stream_batch(event, records):
+    # Like "pages", but each label is rendered on its own canvas, appended to the output and
+    # released; the PDF goes to S3 in parts while later records render. Memory stays flat
+    # with the number of records, shared objects (fonts, the background) are written once.
+    from pdfstream import StreamingPdfWriter, S3MultipartWriter
+    rendered = []
+    failed = []
+    file_name = f'{event.get("output_name", "batch")}.pdf'
+    fingerprint = batch_fingerprint(records, "stream")
+    if output_is_current(records[0] if records else event, file_name, fingerprint):
+        unchanged = [str(data["variables"]["item"]["orderItemId"]) for data in records]
+        return batch_response(rendered, unchanged, [file_name], failed)
+    if not records:
+        return batch_response(rendered, [], [], failed)
+
+    pool = get_process_pool()
+    if pool is not None:
+        warm_symbol_cache(records, pool)
+    s3 = get_s3_client()
+    bucket = records[0]["variables"]["bucket"]
+    key = f'{records[0]["output_path"]}/{file_name}'
+    extra_args = {'ContentType': 'application/pdf'}
+    if fingerprint is not None:
+        extra_args['Metadata'] = {FINGERPRINT_METADATA: fingerprint}
+
+    from pipeline import Pipeline, Stage
+    with S3MultipartWriter(s3, bucket, key, STREAM_PART_BYTES, get_fetch_executor(), extra_args) as sink:
+        writer = StreamingPdfWriter(sink)
+
+        def render_page(job):
+            job.order_item_id = str(job.data["variables"]["item"]["orderItemId"])
+            job.output = render_label(job.data, job.prefetched)
+            job.prefetched = None
+            return True
+
+        def write_page(job):
+            with stage("stream_write"):
+                writer.add_page(job.output)
+            job.output = None
+            return True
+
+        # Pages are appended in record order while later records download and render
+        jobs, failed = run_jobs(Pipeline([
+            Stage("fetch", fetch_job_assets, PIPELINE_IO_WORKERS),
+            Stage("render", render_page),
+            Stage("write", write_page, ordered=True),
+        ], PIPELINE_DEPTH), records)
+        rendered = [job.order_item_id for job in jobs]
+        if not rendered:
+            sink.abort()
+            return batch_response(rendered, [], [], failed)
+        writer.close()
+        with stage("upload"):
+            sink.close()
+    count("bytes_out", sink.bytes_written)
+    count("stream_shared_objects", writer.shared_hits)
+
+    if failed and fingerprint is not None:
+        # A document missing failed records must not look current to the retry
+        s3.copy_object(Bucket=bucket, Key=key, CopySource={'Bucket': bucket, 'Key': key},
+                       ContentType='application/pdf', Metadata={}, MetadataDirective='REPLACE')
+    return batch_response(rendered, [], [file_name], failed)
+
+def impose_batch(event, records):
+    # "batch_output": "sheet" tiles the labels onto print sheets (Letter by default) so the
+    # printer spools one document instead of a PDF per label. The first label sets the cell
+    # size; every position draws the template background from the same shared form.
+    from imposition import SheetLayout
+    from renderer import pdf_canvas
+    rendered = []
+    failed = []
+    file_name = f'{event.get("output_name", "batch")}.pdf'
+    fingerprint = batch_fingerprint(records, "sheet")
+    if output_is_current(records[0] if records else event, file_name, fingerprint):
+        unchanged = [str(data["variables"]["item"]["orderItemId"]) for data in records]
+        return batch_response(rendered, unchanged, [file_name], failed)
+
+    pool = get_process_pool()
+    if pool is not None:
+        warm_symbol_cache(records, pool)
+    pdf_buffer = BytesIO()
+    c = pdf_canvas(pdf_buffer)
+    layout = None
+    placed = []
+
+    def place_label(job):
+        nonlocal layout
+        drawing = job.drawing
+        if layout is None:
+            layout = SheetLayout(event.get("sheet"), drawing.width, drawing.height)
+        elif not layout.fits(drawing.width, drawing.height):
+            raise ValueError(f"Label is {drawing.width:g}x{drawing.height:g}pt, the sheet cells are "
+                             f"{layout.label_size[0]:g}x{layout.label_size[1]:g}pt")
+        with stage("pdf_render"):
+            cell = len(placed) % layout.per_sheet
+            if cell == 0:
+                if placed:
+                    c.showPage()
+                c.setPageSize(layout.page_size)
+                layout.draw_crop_marks(c)
+            # Each label stays inside its cell, out of the gutter and its neighbours
+            draw_label(c, drawing, job.layers.background, *layout.positions[cell], clip=True)
+        placed.append(job)
+        job.drawing = None
+        return True
+
+    jobs, failed = draw_batch(records, place_label)
+    rendered = [job.order_item_id for job in jobs]
+    if rendered:
+        c.showPage()
+        with stage("pdf_save"):
+            c.save()
+        count("sheets", math.ceil(len(rendered) / layout.per_sheet))
+        # A document missing failed records must not look current to the retry
+        upload_pdf(records[0], file_name, pdf_buffer.getvalue(), None if failed else fingerprint)
+    return batch_response(rendered, [], [file_name] if rendered else [], failed)
+
+def batch_response(rendered, unchanged, outputs, failed):
+    if not failed:
+        status_code = 200
+    elif rendered or unchanged:
+        status_code = 207
+    else:
+        status_code = 500
+    return {
+        'statusCode': status_code,
+        'body': json.dumps({'rendered': rendered, 'unchanged': unchanged, 'outputs': outputs, 'failed': failed})
+    }
+
+def sheet_groups(messages):
+    # Messages asking for "batch_output": "sheet" are collected per output location and sheet
+    # layout, so labels that arrive one per message still print as one imposed document
+    groups = OrderedDict()
+    others = []
+    for message in messages:
+        try:
+            body = json.loads(message["body"])
+        except ValueError:
+            body = None
+        if isinstance(body, dict) and body.get("batch_output") == "sheet" and "records" not in body:
+            key = (json.dumps(body.get("variables", {}).get("bucket")), json.dumps(body.get("output_path")),
+                   json.dumps(body.get("output_name")), json.dumps(body.get("sheet"), sort_keys=True))
+            groups.setdefault(key, []).append((message, body))
+        else:
+            others.append(message)
+    return list(groups.values()), others
+
+def handle_sheet_group(group):
+    # Returns the messages whose label did not make it onto the sheet
+    bodies = [body for _, body in group]
+    first = bodies[0]
+    # Named after the first label, so a later sheet with the same output_name does not replace this one
+    order_item_id = first.get("variables", {}).get("item", {}).get("orderItemId")
+    event = {
+        'records': bodies,
+        'batch_output': "sheet",
+        'output_name': f'{first.get("output_name", "sheet")}-{order_item_id}',
+        'sheet': first.get("sheet"),
+    }
+    try:
+        response = lambda_handler(event, None)
+        failed = json.loads(response['body'])['failed']
+    except Exception as e:
+        print(f"Sheet of {len(group)} messages failed: {type(e).__name__}: {e}")
+        return [message for message, _ in group]
+    for entry in failed:
+        print(f"Message {group[entry['index']][0].get('messageId')} failed: {entry['error']}")
+    return [group[entry['index']][0] for entry in failed]
+
+def handle_sqs_batch(event):
+    # SQS delivers one label event per message body; failed messages are returned
+    # in the partial batch response format so only they are retried
+    failures = []
+    groups, messages = sheet_groups(event["Records"])
+    for group in groups:
+        failures += [{'itemIdentifier': message["messageId"]} for message in handle_sheet_group(group)]
+    for message in messages:
+        try:
+            response = lambda_handler(json.loads(message["body"]), None)
+            if response['statusCode'] != 200:
+                raise RuntimeError(response['body'])
+        except Exception as e:
+            print(f"Message {message.get('messageId')} failed: {type(e).__name__}: {e}")
+            failures.append({'itemIdentifier': message["messageId"]})
+    return {'batchItemFailures': failures}
+
+def lambda_handler(event, context):
+    # SQS messages are each measured by their own nested lambda_handler call
+    if "Records" in event:
+        return handle_sqs_batch(event)
+
+    # One metrics record per invocation: stage timings, cache hit rates, bytes and peak memory
+    with collect_metrics(event.get("debug")) as metrics, remember_versions():
+        response = handle_event(event)
+    emit_metrics(metrics, request_id=getattr(context, "aws_request_id", None),
+                 records=len(event.get("records", [])) or 1, status_code=response['statusCode'])
+    if event.get("include_metrics"):
+        response['metrics'] = metrics.as_dict()
+    return response
+
+def handle_event(event):
+    # The event already is the JSON data, no need to round trip it through /tmp
+    data = event
+    if "records" in data:
+        return handle_batch(data)
+
+    # Convert the final SVG to PDF using orderItemId as the filename
+    order_item_id = str(data["variables"]["item"]["orderItemId"])
+    file_name = output_file_name(data, order_item_id)
+    kind = OUTPUT_FORMATS[label_output_format(data)][2]
+    # Retries and replays of the same event find their output already current
+    fingerprint = label_fingerprint(data)
+    if output_is_current(data, file_name, fingerprint):
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f'{kind} {file_name} is already up to date.')
+        }
+    upload_pdf(data, file_name, render_label_cached(data, fingerprint), fingerprint)
 
     return {
         'statusCode': 200,
-        'body': json.dumps(f'PDF created and uploaded successfully as {order_item_id}.pdf.')
+        'body': json.dumps(f'{kind} created and uploaded successfully as {file_name}.')
     }
 
 if __name__ == "__main__":
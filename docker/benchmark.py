@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import copy
+import time
+import zlib
+import random
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from io import BytesIO
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# Drives lambda_handler end to end against the sample template and payload, with S3 and
+# image URLs served from memory, so results only depend on this machine and this tree.
+# Every scenario runs in its own process: cold start and peak memory are per scenario.
+#
+#   python benchmark.py                          run every scenario, print the report
+#   python benchmark.py --output base.json       ... and save the results
+#   python benchmark.py --baseline base.json     ... and fail on p50 regressions
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assets")
+TEMPLATE_FILE = os.path.join(ASSETS_DIR, "2x2_QC_template.svg")
+TEMPLATES_FILE = os.path.join(ASSETS_DIR, "templates.json")
+SAMPLE_INPUT_FILE = os.path.join(ASSETS_DIR, "label_sample_input.json")
+
+BENCH_BUCKET = "benchmark"
+SVG_NAMESPACE = "{http://www.w3.org/2000/svg}"
+# Image slots of the sample template that events can fill from a URL
+TEMPLATE_IMAGE_SLOTS = ["Layer_0_xA0_Image", "black_rectangle_1_xA0_Image", "black_rectangle_2_xA0_Image"]
+
+class StubBody:
+    def __init__(self, data):
+        self._data = data
+
+    def read(self):
+        return self._data
+
+class StubS3:
+    # The subset of the boto3 S3 client the handler uses, kept in a dict. Every request
+    # waits latency seconds, like a round trip to S3 would.
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.objects = {}
+        self.metadata = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def put(self, bucket, key, data, metadata=None):
+        with self.lock:
+            self.objects[(bucket, key)] = data
+            self.metadata[(bucket, key)] = dict(metadata or {})
+
+    def etag(self, data):
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
+    def request(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def lookup(self, bucket, key, operation):
+        self.request()
+        if (bucket, key) not in self.objects:
+            from botocore.exceptions import ClientError
+            raise ClientError({'Error': {'Code': "404", 'Message': "Not Found"}}, operation)
+        return self.objects[(bucket, key)]
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data = self.lookup(Bucket, Key, "HeadObject")
+        return {'ETag': self.etag(data), 'ContentLength': len(data), 'Metadata': self.metadata[(Bucket, Key)]}
+
+    def get_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        data = self.lookup(Bucket, Key, "GetObject")
+        if IfMatch is not None and IfMatch != self.etag(data):
+            raise RuntimeError(f"PreconditionFailed for s3://{Bucket}/{Key}")
+        return {'Body': StubBody(data), 'ETag': self.etag(data), 'ContentLength': len(data)}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        with open(Filename, 'wb') as file:
+            file.write(self.lookup(Bucket, Key, "GetObject"))
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        self.request()
+        self.put(Bucket, Key, Fileobj.read(), (ExtraArgs or {}).get('Metadata'))
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+        self.request()
+        with open(Filename, 'rb') as file:
+            self.put(Bucket, Key, file.read(), (ExtraArgs or {}).get('Metadata'))
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        self.request()
+        self.put(Bucket, Key, Body if isinstance(Body, bytes) else Body.read(), Metadata)
+        return {'ETag': self.etag(self.objects[(Bucket, Key)])}
+
+    def copy_object(self, Bucket, Key, CopySource, Metadata=None, **kwargs):
+        self.put(Bucket, Key, self.lookup(CopySource['Bucket'], CopySource['Key'], "CopyObject"), Metadata)
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        self.request()
+        with self.lock:
+            upload_id = str(len(self.uploads) + 1)
+            self.uploads[upload_id] = ({}, Metadata)
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.request()
+        with self.lock:
+            self.uploads[UploadId][0][PartNumber] = Body
+        return {'ETag': self.etag(Body)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.request()
+        parts, metadata = self.uploads.pop(UploadId)
+        self.put(Bucket, Key, b"".join(parts[part['PartNumber']] for part in MultipartUpload['Parts']), metadata)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.uploads.pop(UploadId, None)
+
+class ImageServer(ThreadingMixIn, HTTPServer):
+    # Serves generated photos on 127.0.0.1 so image downloads go through the real HTTP path
+    daemon_threads = True
+
+    def __init__(self, images):
+        super().__init__(("127.0.0.1", 0), ImageRequestHandler)
+        self.images = images
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.server_address[1]}/{name}"
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.images.get(self.path.lstrip("/"))
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def generate_photo(seed, size):
+    # Noisy gradient: compresses like a real photo, unlike a flat colour
+    from PIL import Image
+    rng = random.Random(seed)
+    pixels = bytes(
+        (x * 255 // size + rng.randrange(64)) % 256
+        for y in range(size) for x in range(size) for _ in range(3)
+    )
+    buffer = BytesIO()
+    Image.frombytes("RGB", (size, size), pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def replicate_slot(svg_bytes, slot_id, copies):
+    # Copy of the template with the slot repeated on a grid, ids slot_id_0 .. slot_id_{copies-1}
+    from lxml import etree
+    root = etree.fromstring(svg_bytes, etree.XMLParser(huge_tree=True))
+    slot = next(element for element in root.iter(f"{SVG_NAMESPACE}image") if element.get("id") == slot_id)
+    columns = max(1, int(copies ** 0.5 + 0.999))
+    cell = 144.0 / columns
+    width, height = float(slot.get("width")), float(slot.get("height"))
+    scale = cell * 0.9 / max(width, height)
+    for position in range(copies):
+        row, column = divmod(position, columns)
+        element = copy.deepcopy(slot)
+        element.set("id", f"{slot_id}_{position}")
+        element.set("transform", f"matrix({scale:.4f} 0 0 {scale:.4f} {column * cell:.2f} {row * cell:.2f})")
+        slot.getparent().append(element)
+    slot.getparent().remove(slot)
+    return etree.tostring(root)
+
+def base_event():
+    # The RJD entry of templates.json with the sample order as its variables
+    template = json.load(open(TEMPLATES_FILE))["main"]["PDF_templates"]["RJD"]
+    variables = json.load(open(SAMPLE_INPUT_FILE))
+    variables["bucket"] = BENCH_BUCKET
+    return {
+        'template_path': f"s3://{BENCH_BUCKET}/templates/2x2_QC_template.svg",
+        'output_path': "benchmark",
+        'variables': variables,
+        'barcodes': [{'id': "barcode", 'data': "variables.orderId",
+                      'attributes': template["variables"]["barcode"]["attributes"]}],
+        'matrixcodes': [{'id': "datamatrix", 'data': "variables.item.orderItemId",
+                         'attributes': template["variables"]["matrixcode"]["attributes"]}],
+        'images': [],
+    }
+
+def with_order_item(event, order_item_id):
+    event = copy.deepcopy(event)
+    event["variables"]["item"]["orderItemId"] = order_item_id
+    return event
+
+def batch_records(count):
+    return [{'variables': {'item': dict(base_event()["variables"]["item"], orderItemId=135802750 + n)}}
+            for n in range(count)]
+
+# Each scenario returns (events to render one after another, labels per event)
+def scenario_single(s3, images, size):
+    event = base_event()
+    return [with_order_item(event, 135802750 + n) for n in range(size)], 1
+
+def scenario_zpl(s3, images, size):
+    # Single labels as ZPL for a thermal printer instead of PDF
+    event = dict(base_event(), output_format="zpl")
+    return [with_order_item(event, 135802750 + n) for n in range(size)], 1
+
+def scenario_batch_files(s3, images, size):
+    event = dict(base_event(), records=batch_records(size))
+    return [event], size
+
+def scenario_batch_pages(s3, images, size):
+    event = dict(base_event(), records=batch_records(size), batch_output="pages", output_name="benchmark")
+    return [event], size
+
+def scenario_batch_stream(s3, images, size):
+    event = dict(base_event(), records=batch_records(size), batch_output="stream", output_name="benchmark")
+    return [event], size
+
+def scenario_batch_sheet(s3, images, size):
+    event = dict(base_event(), records=batch_records(size), batch_output="sheet", output_name="benchmark")
+    return [event], size
+
+def scenario_matrixcodes(s3, images, size):
+    # 25 Data Matrix codes per label, all different
+    copies = 25
+    s3.put(BENCH_BUCKET, "templates/matrixcodes.svg",
+           replicate_slot(open(TEMPLATE_FILE, 'rb').read(), "datamatrix", copies))
+    events = []
+    for n in range(size):
+        event = base_event()
+        event["template_path"] = f"s3://{BENCH_BUCKET}/templates/matrixcodes.svg"
+        event["variables"]["codes"] = [f"{135802750 + n}-{position:02d}" for position in range(copies)]
+        event["matrixcodes"] = [{'id': f"datamatrix_{position}", 'data': f"variables.codes.{position}",
+                                 'attributes': {'scale': 1.0}} for position in range(copies)]
+        events.append(with_order_item(event, 135802750 + n))
+    return events, 1
+
+def scenario_reprint(s3, images, size):
+    # The same few events replayed over and over, as Lambda retries and upstream replays do;
+    # only the first delivery of each renders
+    event = base_event()
+    originals = [with_order_item(event, 135802750 + n) for n in range(3)]
+    return [dict(originals[n % len(originals)], force_render=False) for n in range(size)], 1
+
+def scenario_images(s3, images, size):
+    # 12 photos per label downloaded over HTTP plus the template's own image slots,
+    # a different set for every label so the image cache does not hide the downloads
+    copies = 12
+    s3.put(BENCH_BUCKET, "templates/images.svg",
+           replicate_slot(open(TEMPLATE_FILE, 'rb').read(), "Layer_0_xA0_Image", copies))
+    events = []
+    for n in range(size):
+        event = base_event()
+        event["template_path"] = f"s3://{BENCH_BUCKET}/templates/images.svg"
+        slots = [f"Layer_0_xA0_Image_{position}" for position in range(copies)] + TEMPLATE_IMAGE_SLOTS[1:]
+        for position, slot_id in enumerate(slots):
+            name = f"photo-{n}-{position}.png"
+            images.images[name] = generate_photo(n * 100 + position, 320)
+            event["images"].append({'id': slot_id, 'source': images.url(name), 'attributes': {'scale': 1.0}})
+        events.append(with_order_item(event, 135802750 + n))
+    return events, 1
+
+def check_sheet_cells(outputs):
+    # Every label on a sheet is clipped to its cell, so artwork reaching past the label's edge
+    # (the sample's Data Matrix does) stays out of the gutter and the neighbouring labels
+    from pdfstream import read_objects, split_dictionary
+    for pdf in outputs:
+        objects = read_objects(pdf)
+        for body in objects.values():
+            match = re.search(rb'/Contents (\d+) 0 R', split_dictionary(body)[0])
+            if match is None:
+                continue
+            stream = split_dictionary(objects[int(match.group(1))])[1]
+            content = zlib.decompress(stream[len(b"\nstream\n"):stream.rindex(b"endstream")].strip())
+            labels = content.count(b"/FormXob.TemplateBackground")
+            clipped = len(re.findall(rb"0 0 [\d.]+ [\d.]+ re W\*? n\n/FormXob\.TemplateBackground", content))
+            if not labels or clipped != labels:
+                raise RuntimeError(f"batch_sheet: {labels - clipped} of {labels} labels on a sheet are not clipped to their cell")
+
+# Checks of a scenario's outputs, run after its timings are taken
+SCENARIO_CHECKS = {
+    'batch_sheet': check_sheet_cells,
+}
+
+# name -> (builder, default size, default repeat)
+SCENARIOS = {
+    'single': (scenario_single, 40, 1),
+    'zpl': (scenario_zpl, 40, 1),
+    'batch_files': (scenario_batch_files, 25, 4),
+    'batch_pages': (scenario_batch_pages, 25, 4),
+    'batch_stream': (scenario_batch_stream, 25, 4),
+    'batch_sheet': (scenario_batch_sheet, 25, 4),
+    'matrixcodes': (scenario_matrixcodes, 10, 1),
+    'images': (scenario_images, 10, 1),
+    'reprint': (scenario_reprint, 40, 1),
+}
+
+def percentile(values, fraction):
+    # Linear interpolation between closest ranks
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def summarize(values):
+    return {
+        'p50': round(percentile(values, 0.50), 2),
+        'p90': round(percentile(values, 0.90), 2),
+        'p99': round(percentile(values, 0.99), 2),
+        'max': round(max(values), 2) if values else 0.0,
+    }
+
+def run_scenario(name, size, repeat, s3_latency=0):
+    # Runs in a fresh process, see main()
+    os.environ["RENDER_METRICS"] = "0"
+    # svglib warns about the template's missing fonts on every render
+    logging.disable(logging.WARNING)
+    os.environ.setdefault("IMAGE_CACHE_DIR", tempfile.mkdtemp(prefix="benchmark-images-"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    import metrics
+
+    s3 = StubS3(s3_latency / 1000)
+    s3.put(BENCH_BUCKET, "templates/2x2_QC_template.svg", open(TEMPLATE_FILE, 'rb').read())
+    app._s3_client = s3
+    images = ImageServer({})
+    threading.Thread(target=images.serve_forever, daemon=True).start()
+
+    build, default_size, default_repeat = SCENARIOS[name]
+    events, labels_per_event = build(s3, images, size or default_size)
+    repeat = repeat or default_repeat
+
+    latencies = []
+    stages = {}
+    labels = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for event in events:
+            # Every scenario but reprint measures rendering, not the skipped re-render of a repeat
+            event = dict({'force_render': True}, **event, include_metrics=True)
+            response = app.lambda_handler(event, None)
+            if response['statusCode'] != 200:
+                raise RuntimeError(f"{name}: {response['body']}")
+            latencies.append(response['metrics']['total_ms'])
+            for stage_name, entry in response['metrics']['stages'].items():
+                stages.setdefault(stage_name, []).append(entry['ms'])
+            labels += labels_per_event
+    elapsed = time.perf_counter() - started
+
+    outputs = [data for (bucket, key), data in s3.objects.items() if key.startswith("benchmark/")]
+    if name in SCENARIO_CHECKS:
+        SCENARIO_CHECKS[name](outputs)
+    return {
+        'renders': len(latencies),
+        'labels': labels,
+        'cold_ms': round(latencies[0], 2),
+        'latency_ms': summarize(latencies[1:] or latencies),
+        'labels_per_second': round(labels / elapsed, 2),
+        'stages_ms': {stage_name: summarize(values) for stage_name, values in stages.items()},
+        'peak_rss_mb': metrics.peak_rss_mb(),
+        'pdf_bytes': round(sum(len(data) for data in outputs) / max(len(outputs), 1)),
+    }
+
+IMPORT_PROBE = """
+import sys, json, time, importlib
+started = time.perf_counter()
+import app
+modules = {'app': time.perf_counter() - started}
+for name in app.LAZY_MODULES:
+    started = time.perf_counter()
+    importlib.import_module(name)
+    modules[name] = time.perf_counter() - started
+print(json.dumps(modules))
+"""
+
+def measure_imports():
+    # Cold 'import app' in a fresh interpreter, then each lazily imported module in the order
+    # app lists them; dependencies shared between modules count towards the first one
+    completed = subprocess.run([sys.executable, "-c", IMPORT_PROBE], stdout=subprocess.PIPE, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    modules = json.loads(completed.stdout.decode('utf-8').strip().splitlines()[-1])
+    startup = modules.pop('app')
+    return {
+        'startup_ms': round(startup * 1000, 2),
+        'lazy_ms': round(sum(modules.values()) * 1000, 2),
+        'lazy_modules_ms': {name: round(seconds * 1000, 2) for name, seconds in modules.items()},
+    }
+
+def scenario_results(results):
+    return {name: result for name, result in results.items() if name in SCENARIOS}
+
+def print_imports(imports):
+    print(f"\nImports: 'import app' {imports['startup_ms']:.1f} ms, "
+          f"lazily loaded modules {imports['lazy_ms']:.1f} ms")
+    for name, ms in imports['lazy_modules_ms'].items():
+        print(f"  {name:<32}{ms:>9.1f} ms")
+
+def print_report(results):
+    print(f"{'scenario':<14}{'labels':>8}{'cold ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+          f"{'labels/s':>10}{'rss MB':>9}{'pdf B':>9}")
+    for name, result in scenario_results(results).items():
+        latency = result['latency_ms']
+        print(f"{name:<14}{result['labels']:>8}{result['cold_ms']:>10.1f}{latency['p50']:>10.1f}"
+              f"{latency['p90']:>10.1f}{latency['p99']:>10.1f}{result['labels_per_second']:>10.1f}"
+              f"{result['peak_rss_mb']:>9.1f}{result['pdf_bytes']:>9}")
+    if 'imports' in results:
+        print_imports(results['imports'])
+    for name, result in scenario_results(results).items():
+        print(f"\n{name} stages (ms per invocation)")
+        for stage_name, summary in sorted(result['stages_ms'].items(), key=lambda item: -item[1]['p50']):
+            print(f"  {stage_name:<22}p50 {summary['p50']:>9.2f}   p90 {summary['p90']:>9.2f}   max {summary['max']:>9.2f}")
+
+def compare(results, baseline, threshold):
+    # A scenario regresses when its p50 latency, throughput, memory or PDF size gets worse by more than threshold
+    regressions = []
+    checks = [
+        ('p50 ms', lambda result: result['latency_ms']['p50'], 1),
+        ('labels/s', lambda result: result['labels_per_second'], -1),
+        ('peak rss MB', lambda result: result['peak_rss_mb'], 1),
+        ('pdf bytes', lambda result: result['pdf_bytes'], 1),
+    ]
+    print(f"\nCompared with baseline (threshold {threshold:.0%})")
+    if 'imports' in results and 'imports' in baseline:
+        before, after = baseline['imports']['startup_ms'], results['imports']['startup_ms']
+        change = (after - before) / before if before else 0.0
+        flag = "REGRESSION" if change > threshold else ""
+        print(f"  {'imports':<14}{'startup ms':<14}{before:>10.1f} -> {after:>10.1f}  {change:+7.1%}  {flag}")
+        if flag:
+            regressions.append("imports startup ms")
+    for name, result in scenario_results(results).items():
+        if name not in baseline:
+            continue
+        for label, value, direction in checks:
+            before, after = value(baseline[name]), value(result)
+            if not before:
+                continue
+            change = (after - before) / before
+            flag = "REGRESSION" if change * direction > threshold else ""
+            print(f"  {name:<14}{label:<14}{before:>10.1f} -> {after:>10.1f}  {change:+7.1%}  {flag}")
+            if flag:
+                regressions.append(f"{name} {label}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lambda_handler with local S3 and image stand-ins")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run, repeatable (default: all)")
+    parser.add_argument("--size", type=int, default=0, help="Labels (or batch records) per scenario")
+    parser.add_argument("--repeat", type=int, default=0, help="Times each scenario's events are rendered")
+    parser.add_argument("--output", help="Write the results as JSON, e.g. to use as a baseline")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--s3-latency", type=float, default=0, help="Milliseconds every S3 request takes")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed slowdown before failing")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        name = args.scenario[0]
+        print(json.dumps(run_scenario(name, args.size, args.repeat, args.s3_latency)))
+        return 0
+
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        command = [sys.executable, os.path.abspath(__file__), "--child", "--scenario", name,
+                   "--size", str(args.size), "--repeat", str(args.repeat), "--s3-latency", str(args.s3_latency)]
+        completed = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+        results[name] = json.loads(completed.stdout.decode('utf-8').strip().splitlines()[-1])
+
+    results['imports'] = measure_imports()
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            print(f"\nRegressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+import os
+import fcntl
+import hashlib
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    # Thread safe in-memory LRU bounded by the total size of its values (len() of each value)
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= len(previous)
+            self._items[key] = value
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._items), 'bytes': self.current_bytes}
+
+class DiskCache:
+    # Byte blobs under a directory, one file per key, evicted least recently used first.
+    # Survives between warm invocations as long as the directory (e.g. /tmp) does. The
+    # directory itself is the index: processes sharing it (server workers) read each other's
+    # files, mark use by the file's mtime and evict under one file lock, so max_bytes bounds
+    # the directory as a whole rather than each process. The lock file holds the directory's
+    # running total; only a put that takes it over max_bytes scans the directory, and then
+    # trims it to EVICT_TO of the limit so the next puts do not scan again.
+    LOCK_NAME = ".lock"
+    EVICT_TO = 0.9
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _name(key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _entries(self):
+        # (mtime, name, size) of every complete file, oldest use first
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp") or entry.name == self.LOCK_NAME:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.is_file():
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        return sorted(entries)
+
+    def get(self, key):
+        path = self._path(self._name(key))
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            # mtime is the recency every process evicts by; atime is often not kept
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process since, the bytes read are still good
+            pass
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        name = self._name(key)
+        # Write under a temporary name first so readers never see a partial file
+        temp_path = self._path(f"{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        path = self._path(name)
+        with open(self._path(self.LOCK_NAME), 'a+') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            lock.seek(0)
+            total = lock.read()
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(temp_path, path)
+            if total:
+                total = int(total) + len(data) - replaced
+            else:
+                # First put into this directory, or one left by an older version
+                total = sum(size for _, _, size in self._entries())
+            if total > self.max_bytes:
+                total = self._evict(self.max_bytes * self.EVICT_TO)
+            lock.seek(0)
+            lock.truncate()
+            lock.write(str(total))
+
+    def _evict(self, target):
+        # Oldest files first until the directory holds at most target bytes; the scan also
+        # corrects the running total for files removed behind the cache's back
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        for _, name, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    def stats(self):
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(entries),
+                'bytes': sum(size for _, _, size in entries)}
+
+class TieredCache:
+    # Memory in front of disk; disk hits are promoted to memory
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        self.disk.put(key, value)
+
+    def stats(self):
+        return {'memory': self.memory.stats(), 'disk': self.disk.stats()}
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import logging
+
+import app
+
+# Compiles an SVG template ahead of time into the artifact app.load_template reads: the tree
+# without its base64 rasters, the decoded raster table, the slot table, the variable paths and
+# the static backgrounds pre-rendered for the given sets of dynamic slots. Events then point
+# template_path at the artifact instead of the SVG. Templates are validated first, nothing is
+# written when a slot an event targets does not exist. Artifacts are signed with
+# TEMPLATE_ARTIFACT_KEY, which the handler needs too.
+#
+#   python compiler.py RJD --templates ../assets/templates.json --dynamic barcode,datamatrix
+#   python compiler.py s3://bucket/template.svg --event event.json -o s3://bucket/template.compiled
+#   python compiler.py template.svg --event event.json --check
+
+def resolve_source(source, templates_path):
+    # A name from templates.json (template path and sample variables), or a template path
+    if templates_path:
+        entries = app.read_json(templates_path)["main"]["PDF_templates"]
+        if source in entries:
+            entry = entries[source]
+            template_path = entry["template_path"]
+            # templates.json paths are relative to the repository root, next to the assets
+            if not template_path.startswith("s3://") and not os.path.isabs(template_path):
+                root = os.path.dirname(os.path.dirname(os.path.abspath(templates_path)))
+                template_path = os.path.join(root, template_path)
+            return template_path, entry.get("variables")
+    return source, None
+
+def event_dynamic_ids(event):
+    return {str(entry["id"]) for entry in event.get("barcodes", []) + event.get("matrixcodes", []) + event.get("images", [])}
+
+def validate_template(compiled, dynamic_sets, variables):
+    # Errors stop the artifact from being written, warnings are only reported
+    errors = []
+    warnings = []
+    slots = compiled.slot_table()
+    image_ids = {element_id for element_id, entries in slots.items()
+                 if any(entry['tag'] == "image" for entry in entries)}
+    for dynamic_ids in dynamic_sets:
+        for element_id in sorted(dynamic_ids - image_ids):
+            errors.append(f"'{element_id}' is not an image slot of the template")
+    for element_id, entries in sorted(slots.items()):
+        if len(entries) > 1:
+            warnings.append(f"'{element_id}' is used by {len(entries)} elements, all of them are replaced")
+        for entry in entries:
+            if entry.get('size_pt') == [0, 0]:
+                errors.append(f"image slot '{element_id}' has no width/height")
+    if variables is not None:
+        for element_id in sorted(compiled.text_ids):
+            if not app.get_value_from_json_path(variables, element_id):
+                warnings.append(f"text slot '{element_id}' does not resolve in the sample variables")
+    return errors, warnings
+
+def write_output(output, data):
+    if output.startswith("s3://"):
+        bucket_name, key = app.split_s3_path(output)
+        app.get_s3_client().put_object(Bucket=bucket_name, Key=key, Body=data)
+    else:
+        with open(output, 'wb') as file:
+            file.write(data)
+
+def default_output(template_path):
+    base, _ = os.path.splitext(template_path)
+    return f"{base}.compiled"
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile an SVG label template into a fast-loading artifact")
+    parser.add_argument("source", help="Template name in --templates, or a local or s3:// SVG path")
+    parser.add_argument("--templates", help="templates.json to look the template name up in")
+    parser.add_argument("--event", action="append", default=[],
+                        help="Sample event JSON; its slot ids are validated and its layers pre-rendered (repeatable)")
+    parser.add_argument("--dynamic", action="append", default=[],
+                        help="Comma separated image slot ids an event replaces (repeatable, one set each)")
+    parser.add_argument("-o", "--output", help="Artifact path or s3:// URL (default: <template>.compiled)")
+    parser.add_argument("--check", action="store_true", help="Validate only, write nothing")
+    parser.add_argument("--strict", action="store_true", help="Treat warnings as errors")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    if not args.check and not app.TEMPLATE_ARTIFACT_KEY:
+        print("TEMPLATE_ARTIFACT_KEY must be set to sign the artifact", file=sys.stderr)
+        return 1
+
+    template_path, variables = resolve_source(args.source, args.templates)
+    dynamic_sets = []
+    for event_path in args.event:
+        event = app.read_json(event_path)
+        variables = event.get("variables", variables)
+        dynamic_sets.append(event_dynamic_ids(event))
+    dynamic_sets += [{slot_id.strip() for slot_id in ids.split(",") if slot_id.strip()} for ids in args.dynamic]
+
+    etag = app.get_template_etag(template_path)
+    svg_bytes, etag = app.fetch_template_bytes(template_path, etag)
+    if svg_bytes.startswith(app.TEMPLATE_ARTIFACT_MAGIC):
+        print(f"{template_path} is already a compiled artifact", file=sys.stderr)
+        return 1
+    compiled = app.compile_svg_template(template_path, etag, svg_bytes)
+
+    errors, warnings = validate_template(compiled, dynamic_sets, variables)
+    for warning in warnings:
+        print(f"warning: {warning}", file=sys.stderr)
+    for error in errors:
+        print(f"error: {error}", file=sys.stderr)
+    if errors or (args.strict and warnings):
+        return 1
+
+    slots = compiled.slot_table()
+    print(f"{template_path}: {len(slots)} slot ids, {len(compiled.text_ids)} variable paths, "
+          f"{len(compiled.rasters.encoded)} rasters")
+    if args.check:
+        return 0
+
+    for dynamic_ids in dynamic_sets:
+        compiled.layers(dynamic_ids)
+    if not dynamic_sets:
+        print("No --event or --dynamic given, backgrounds are rendered at run time", file=sys.stderr)
+
+    data = app.template_artifact_bytes(compiled)
+    output = args.output or default_output(template_path)
+    write_output(output, data)
+    print(f"Wrote {output}: {len(data)} bytes ({len(svg_bytes)} bytes of SVG), {len(dynamic_sets)} pre-rendered layers")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+import math
+
+# Sheet sizes in points, portrait
+PAGE_SIZES = {
+    'letter': (612.0, 792.0),
+    'legal': (612.0, 1008.0),
+    'tabloid': (792.0, 1224.0),
+    'a3': (841.89, 1190.55),
+    'a4': (595.28, 841.89),
+    'a5': (419.53, 595.28),
+}
+DEFAULT_SHEET = {'size': 'letter', 'margin': 18, 'gutter': 9, 'crop_marks': True}
+CROP_MARK_LENGTH = 9
+CROP_MARK_OFFSET = 3
+CROP_MARK_WIDTH = 0.25
+# Labels of a sheet must match its cell size to within this many points
+SIZE_TOLERANCE = 0.01
+
+def sheet_page_size(size, orientation=None):
+    # A name from PAGE_SIZES or [width, height] in points; orientation flips either
+    if isinstance(size, str):
+        if size.lower() not in PAGE_SIZES:
+            raise ValueError(f"Unknown sheet size '{size}', expected one of {', '.join(PAGE_SIZES)} or [width, height]")
+        width, height = PAGE_SIZES[size.lower()]
+    else:
+        width, height = (float(value) for value in size)
+    if orientation == "landscape":
+        return max(width, height), min(width, height)
+    if orientation == "portrait":
+        return min(width, height), max(width, height)
+    return width, height
+
+class SheetLayout:
+    # Grid of equally sized label cells on a sheet, centred inside the margins. Positions are
+    # the bottom-left corners of the cells in reading order, top-left cell first.
+    def __init__(self, options, label_width, label_height):
+        options = dict(DEFAULT_SHEET, **(options or {}))
+        self.page_size = sheet_page_size(options['size'], options.get('orientation'))
+        self.label_size = (label_width, label_height)
+        self.margin = float(options['margin'])
+        self.gutter = float(options['gutter'])
+        self.crop_marks = bool(options['crop_marks'])
+
+        page_width, page_height = self.page_size
+        self.columns = math.floor((page_width - 2 * self.margin + self.gutter) / (label_width + self.gutter))
+        self.rows = math.floor((page_height - 2 * self.margin + self.gutter) / (label_height + self.gutter))
+        # Fewer cells than fit can be asked for, e.g. to match a pre-cut label stock
+        if options.get('columns'):
+            self.columns = min(self.columns, int(options['columns']))
+        if options.get('rows'):
+            self.rows = min(self.rows, int(options['rows']))
+        if self.columns < 1 or self.rows < 1:
+            raise ValueError(f"A {label_width:g}x{label_height:g}pt label does not fit on a "
+                             f"{page_width:g}x{page_height:g}pt sheet with {self.margin:g}pt margins")
+
+        grid_width = self.columns * label_width + (self.columns - 1) * self.gutter
+        grid_height = self.rows * label_height + (self.rows - 1) * self.gutter
+        self.left = (page_width - grid_width) / 2
+        self.bottom = (page_height - grid_height) / 2
+        self.right = self.left + grid_width
+        self.top = self.bottom + grid_height
+        self.positions = [(self.left + column * (label_width + self.gutter),
+                           self.top - label_height - row * (label_height + self.gutter))
+                          for row in range(self.rows) for column in range(self.columns)]
+
+    @property
+    def per_sheet(self):
+        return len(self.positions)
+
+    def fits(self, width, height):
+        return (abs(width - self.label_size[0]) <= SIZE_TOLERANCE
+                and abs(height - self.label_size[1]) <= SIZE_TOLERANCE)
+
+    def cut_lines(self):
+        # x of every column edge and y of every row edge, shared edges once when there is no gutter
+        label_width, label_height = self.label_size
+        xs = sorted({round(x + offset, 3) for x, _ in self.positions[:self.columns] for offset in (0, label_width)})
+        ys = sorted({round(y + offset, 3) for _, y in self.positions[::self.columns] for offset in (0, label_height)})
+        return xs, ys
+
+    def draw_crop_marks(self, c):
+        # Marks sit outside the grid, in the margins, so they never print onto a neighbouring label
+        if not self.crop_marks:
+            return
+        xs, ys = self.cut_lines()
+        vertical = min(CROP_MARK_LENGTH, self.bottom - CROP_MARK_OFFSET)
+        horizontal = min(CROP_MARK_LENGTH, self.left - CROP_MARK_OFFSET)
+        c.saveState()
+        c.setLineWidth(CROP_MARK_WIDTH)
+        c.setStrokeColorRGB(0, 0, 0)
+        if vertical > 0:
+            for x in xs:
+                c.line(x, self.bottom - CROP_MARK_OFFSET, x, self.bottom - CROP_MARK_OFFSET - vertical)
+                c.line(x, self.top + CROP_MARK_OFFSET, x, self.top + CROP_MARK_OFFSET + vertical)
+        if horizontal > 0:
+            for y in ys:
+                c.line(self.left - CROP_MARK_OFFSET, y, self.left - CROP_MARK_OFFSET - horizontal, y)
+                c.line(self.right + CROP_MARK_OFFSET, y, self.right + CROP_MARK_OFFSET + horizontal, y)
+        c.restoreState()
@@ -0,0 +1,159 @@
+import os
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import threading
+import tracemalloc
+import contextvars
+from contextlib import contextmanager
+
+# Structured per-invocation metrics: one JSON log line, CloudWatch EMF when running on Lambda
+METRICS_ENABLED = os.environ.get("RENDER_METRICS", "1") != "0"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "JsonToPdf")
+# "cprofile" or "tracemalloc" attaches a profiler to every request; events can ask with "debug"
+RENDER_DEBUG = os.environ.get("RENDER_DEBUG", "")
+
+_current_metrics = contextvars.ContextVar("render_metrics", default=None)
+
+class RenderMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.debug = {}
+        # Stages also run on fetch threads
+        self._lock = threading.Lock()
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            entry = self.stages.setdefault(name, {'ms': 0.0, 'count': 0})
+            entry['ms'] += seconds * 1000
+            entry['count'] += 1
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def cache_hit_rates(self):
+        # "<cache>_hit" / "<cache>_miss" counter pairs -> hit ratio per cache
+        rates = {}
+        for name in self.counters:
+            if name.endswith("_hit"):
+                cache = name[:-len("_hit")]
+                hits = self.counters[name]
+                total = hits + self.counters.get(f"{cache}_miss", 0)
+                rates[cache] = round(hits / total, 3)
+        for name in self.counters:
+            if name.endswith("_miss") and name[:-len("_miss")] not in rates:
+                rates[name[:-len("_miss")]] = 0.0
+        return rates
+
+    def as_dict(self):
+        result = {
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'stages': {name: {'ms': round(entry['ms'], 2), 'count': entry['count']}
+                       for name, entry in self.stages.items()},
+            'counters': dict(self.counters),
+            'cache_hit_rates': self.cache_hit_rates(),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        result.update(self.debug)
+        return result
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+@contextmanager
+def stage(name):
+    # Time a block into the current request's metrics; a no-op outside collect_metrics
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(name, time.perf_counter() - started)
+
+def count(name, value=1):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add(name, value)
+
+def submit_in_context(executor, function, *args):
+    # Executor threads do not inherit context variables, run the task in a copy of the caller's
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+@contextmanager
+def collect_metrics(debug=None):
+    metrics = RenderMetrics()
+    token = _current_metrics.set(metrics)
+    debug = debug or RENDER_DEBUG
+    profiler = None
+    if debug == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif debug == "tracemalloc" and not tracemalloc.is_tracing():
+        tracemalloc.start(10)
+    try:
+        yield metrics
+    finally:
+        _current_metrics.reset(token)
+        if profiler is not None:
+            profiler.disable()
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(25)
+            metrics.debug['profile'] = output.getvalue()
+        elif debug == "tracemalloc" and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            metrics.debug['tracemalloc'] = {
+                'current_mb': round(current / (1024 * 1024), 2),
+                'peak_mb': round(peak / (1024 * 1024), 2),
+                'top': [str(statistic) for statistic in snapshot.statistics('lineno')[:15]],
+            }
+
+def emf_record(metrics, function_name, properties):
+    # CloudWatch Embedded Metric Format: the log line itself becomes metrics,
+    # dimensioned by function only; properties are searchable but not metrics
+    values = metrics.as_dict()
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['FunctionName']],
+                'Metrics': [{'Name': 'total_ms', 'Unit': 'Milliseconds'},
+                            {'Name': 'peak_rss_mb', 'Unit': 'Megabytes'}]
+                           + [{'Name': f"{name}_ms", 'Unit': 'Milliseconds'} for name in values['stages']]
+                           + [{'Name': name, 'Unit': 'Bytes' if name.startswith('bytes_') else 'Count'}
+                              for name in values['counters']],
+            }],
+        },
+        'FunctionName': function_name,
+        'total_ms': values['total_ms'],
+        'peak_rss_mb': values['peak_rss_mb'],
+    }
+    record.update({f"{name}_ms": entry['ms'] for name, entry in values['stages'].items()})
+    record.update(values['counters'])
+    record['cache_hit_rates'] = values['cache_hit_rates']
+    record.update(properties)
+    return record
+
+def emit_metrics(metrics, **properties):
+    if not METRICS_ENABLED:
+        return
+    function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+    if function_name:
+        record = emf_record(metrics, function_name, properties)
+    else:
+        record = dict(properties, metrics=metrics.as_dict())
+    print(json.dumps(record))
@@ -0,0 +1,190 @@
+import re
+import hashlib
+import threading
+from io import BytesIO
+
+OBJECT_REFERENCE = re.compile(rb'(\d+) 0 R')
+STARTXREF = re.compile(rb'startxref\s+(\d+)')
+PAGE_OBJECT = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+PARENT_ENTRY = re.compile(rb'/Parent\s+\d+ 0 R')
+STREAM_START = b"\nstream\n"
+
+def read_objects(pdf):
+    # {number: body} of a single ReportLab document, located through its xref table
+    xref_start = int(STARTXREF.findall(pdf)[-1])
+    lines = pdf[xref_start:].split(b"trailer", 1)[0].split(b"\n")
+    first, size = (int(value) for value in lines[1].split())
+    offsets = {}
+    for number, line in enumerate(lines[2:2 + size], start=first):
+        fields = line.split()
+        if len(fields) == 3 and fields[2] == b"n":
+            offsets[number] = int(fields[0])
+
+    objects = {}
+    ends = sorted(offsets.values()) + [xref_start]
+    for number, offset in offsets.items():
+        end = ends[ends.index(offset) + 1]
+        chunk = pdf[offset:end]
+        body = chunk[chunk.index(b"obj") + 3:chunk.rindex(b"endobj")]
+        objects[number] = body.strip()
+    return objects
+
+def split_dictionary(body):
+    # References only ever appear in the dictionary part, never inside stream data
+    position = body.find(STREAM_START)
+    if position < 0:
+        return body, b""
+    return body[:position], body[position:]
+
+class StreamingPdfWriter:
+    # Writes one PDF to a file-like sink page by page. Every page arrives as a small complete
+    # PDF (a label rendered on its own canvas); its objects are renumbered into the output
+    # and written right away, so only the xref offsets stay in memory. Objects that are byte
+    # for byte identical once renumbered (fonts, the template background form, images drawn
+    # as XObjects) are written once and shared by every page that uses them.
+    def __init__(self, sink):
+        self.sink = sink
+        self.position = 0
+        self.offsets = []
+        self.page_numbers = []
+        self.shared = {}
+        self.shared_hits = 0
+        self.write(b"%PDF-1.4\n%\x93\x8c\x8b\x9e\n")
+        self.pages_number = self.reserve()
+
+    def write(self, data):
+        self.sink.write(data)
+        self.position += len(data)
+
+    def reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets)
+
+    def write_object(self, number, body):
+        self.offsets[number - 1] = self.position
+        self.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    def add_shared(self, body):
+        digest = hashlib.sha256(body).digest()
+        number = self.shared.get(digest)
+        if number is None:
+            number = self.shared[digest] = self.reserve()
+            self.write_object(number, body)
+        else:
+            self.shared_hits += 1
+        return number
+
+    def copy_object(self, objects, number, mapping, visiting):
+        # Children first, so the parent's bytes (and hash) already use the output numbers
+        if number in mapping:
+            return mapping[number]
+        if number in visiting:
+            raise ValueError(f"Reference cycle through object {number}")
+        visiting.add(number)
+        dictionary, stream = split_dictionary(objects[number])
+        dictionary = self.renumber(dictionary, objects, mapping, visiting)
+        mapping[number] = self.add_shared(dictionary + stream)
+        visiting.discard(number)
+        return mapping[number]
+
+    def renumber(self, dictionary, objects, mapping, visiting):
+        def replace(match):
+            return b"%d 0 R" % self.copy_object(objects, int(match.group(1)), mapping, visiting)
+        return OBJECT_REFERENCE.sub(replace, dictionary)
+
+    def add_page(self, page_pdf):
+        objects = read_objects(page_pdf)
+        pages = [number for number, body in objects.items() if PAGE_OBJECT.search(split_dictionary(body)[0])]
+        mapping = {}
+        for page in pages:
+            # The page tree, catalog and info of the single page document are left behind
+            dictionary = PARENT_ENTRY.sub(b"", objects[page])
+            dictionary = self.renumber(dictionary, objects, mapping, set())
+            number = self.reserve()
+            self.write_object(number, dictionary.replace(b"<<", b"<<\n/Parent %d 0 R" % self.pages_number, 1))
+            self.page_numbers.append(number)
+
+    def close(self):
+        kids = b" ".join(b"%d 0 R" % number for number in self.page_numbers)
+        self.write_object(self.pages_number,
+                          b"<< /Type /Pages /Count %d /Kids [ %s ] >>" % (len(self.page_numbers), kids))
+        catalog = self.reserve()
+        self.write_object(catalog, b"<< /Type /Catalog /Pages %d 0 R >>" % self.pages_number)
+        info = self.reserve()
+        self.write_object(info, b"<< /Producer (json-to-pdf streaming writer) >>")
+
+        xref_start = self.position
+        lines = [b"xref", b"0 %d" % (len(self.offsets) + 1), b"0000000000 65535 f "]
+        lines += [b"%010d 00000 n " % offset for offset in self.offsets]
+        self.write(b"\n".join(lines) + b"\n")
+        self.write(b"trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                   % (len(self.offsets) + 1, catalog, info, xref_start))
+
+class S3MultipartWriter:
+    # File-like sink that uploads to S3 in parts while the caller keeps writing. At most
+    # max_pending parts are buffered or in flight; an output smaller than one part is sent
+    # with a single PUT. Leaving the with block on an exception aborts the upload.
+    def __init__(self, s3, bucket, key, part_bytes, executor, extra_args=None, max_pending=2):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        # S3 parts other than the last must be at least 5 MiB
+        self.part_bytes = max(part_bytes, 5 * 1024 * 1024)
+        self.executor = executor
+        self.extra_args = extra_args or {}
+        self.buffer = BytesIO()
+        self.upload_id = None
+        self.parts = []
+        self.pending = []
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.bytes_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.abort()
+        return False
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.bytes_written += len(data)
+        if self.buffer.tell() >= self.part_bytes:
+            self.flush_part()
+
+    def flush_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                             **self.extra_args)["UploadId"]
+        data = self.buffer.getvalue()
+        self.buffer = BytesIO()
+        part_number = len(self.pending) + 1
+        # Blocks once max_pending parts are waiting, so memory stays bounded if S3 is slower than rendering
+        self.slots.acquire()
+        self.pending.append(self.executor.submit(self.upload_part, part_number, data))
+
+    def upload_part(self, part_number, data):
+        try:
+            response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response["ETag"]}
+        finally:
+            self.slots.release()
+
+    def close(self):
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=self.buffer.getvalue(), **self.extra_args)
+            return
+        if self.buffer.tell():
+            self.flush_part()
+        parts = [future.result() for future in self.pending]
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                          MultipartUpload={'Parts': parts})
+
+    def abort(self):
+        if self.upload_id is not None:
+            for future in self.pending:
+                future.exception()
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
@@ -0,0 +1,87 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+class Stage:
+    # One step records go through. function(item) does the work on an executor thread and
+    # returns whether the item goes on to the next stage; False or an exception ends it there.
+    # An ordered stage takes items in input order, with one worker, e.g. to append pages.
+    def __init__(self, name, function, workers=1, ordered=False):
+        self.name = name
+        self.function = function
+        self.workers = 1 if ordered else max(1, workers)
+        self.ordered = ordered
+
+class Pipeline:
+    # Runs every item through the stages in turn, with each stage working on its own item at
+    # the same time: item N+1 downloads while item N renders and item N-1 uploads. Stages are
+    # connected by queues of at most depth items, so a slow stage holds the ones before it
+    # back instead of piling results up in memory. The asyncio loop only schedules; the
+    # stage functions block (boto3, requests, reportlab) and run on threads of their own.
+    def __init__(self, stages, depth=2):
+        self.stages = stages
+        self.depth = max(1, depth)
+
+    def run(self, items):
+        # {position: exception} of the items a stage raised for
+        return asyncio.run(self.run_async(list(items)))
+
+    async def run_async(self, items):
+        errors = {}
+        context = contextvars.copy_context()
+        workers = sum(stage.workers for stage in self.stages)
+        queues = [asyncio.Queue(self.depth) for _ in self.stages]
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pipeline") as executor:
+            tasks = []
+            for index, stage in enumerate(self.stages):
+                output = queues[index + 1] if index + 1 < len(queues) else None
+                consumers = self.stages[index + 1].workers if output is not None else 0
+                finished = []
+                for _ in range(stage.workers):
+                    tasks.append(asyncio.ensure_future(
+                        self.work(stage, queues[index], output, consumers, finished, executor, context, errors)))
+            try:
+                for position, item in enumerate(items):
+                    await queues[0].put((position, item, True))
+                for _ in range(self.stages[0].workers):
+                    await queues[0].put(None)
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+        return errors
+
+    async def work(self, stage, queue, output, consumers, finished, executor, context, errors):
+        loop = asyncio.get_running_loop()
+        waiting = {}
+        next_position = 0
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                break
+            if stage.ordered:
+                # Held back until every earlier item, including ended ones, came through
+                waiting[entry[0]] = entry
+                ready = []
+                while next_position in waiting:
+                    ready.append(waiting.pop(next_position))
+                    next_position += 1
+            else:
+                ready = [entry]
+            for position, item, active in ready:
+                if active:
+                    try:
+                        # Each call gets a copy of the caller's context, so metrics land in its request
+                        active = await loop.run_in_executor(executor, context.copy().run, stage.function, item)
+                    except Exception as e:
+                        errors[position] = e
+                        active = False
+                # Ended items still pass on, ordered stages later on count every position
+                if output is not None:
+                    await output.put((position, item, bool(active)))
+        # The last worker of a stage to finish tells every worker of the next one
+        finished.append(stage)
+        if output is not None and len(finished) == stage.workers:
+            for _ in range(consumers):
+                await output.put(None)
@@ -0,0 +1,474 @@
+import math
+import functools
+import itertools
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFont, ImageChops, ImageOps
+from reportlab.graphics import shapes
+from reportlab.pdfbase import pdfmetrics
+
+# Output for thermal label printers, straight from the label's reportlab Drawing instead of a
+# PDF the print driver would rasterize again: a 1-bit raster at printer resolution, or ZPL
+# where text, boxes and symbols become native printer commands and only what has no ZPL
+# equivalent (images, paths) is sent as a bitmap.
+
+WHITE = 255
+# Levels between these are gray and dithered, outside them plain black or white
+BLACK_BELOW = 32
+WHITE_ABOVE = 224
+CURVE_STEPS = 16
+ELLIPSE_STEPS = 64
+# ZPL ^GF compression: repeat counts 1-19 are G-Y, multiples of 20 up to 400 are g-z
+ZPL_REPEAT_UNITS = "GHIJKLMNOPQRSTUVWXY"
+ZPL_REPEAT_TWENTIES = "ghijklmnopqrstuvwxyz"
+INVERT_BITS = bytes(255 - value for value in range(256))
+
+def gray_level(color, opacity=1.0):
+    # 0 (black) to 255 (white) as printed on white stock, None when nothing is painted;
+    # reportlab leaves the opacity of most shapes at None, which means opaque
+    opacity = 1.0 if opacity is None else opacity
+    if color is None or opacity <= 0:
+        return None
+    alpha = getattr(color, 'alpha', 1) * opacity
+    luminance = 0.299 * color.red + 0.587 * color.green + 0.114 * color.blue
+    return round(255 - alpha * (1 - luminance) * 255)
+
+def matrix_scale(matrix):
+    return math.sqrt(abs(matrix[0] * matrix[3] - matrix[1] * matrix[2]))
+
+def matrix_inverse(matrix):
+    a, b, c, d, e, f = matrix
+    determinant = a * d - b * c
+    return (d / determinant, -b / determinant, -c / determinant, a / determinant,
+            (c * f - d * e) / determinant, (b * e - a * f) / determinant)
+
+def orientation(matrix):
+    # ZPL field orientation of a transform's x axis on the page: normal, rotated 90 degrees
+    # clockwise, inverted or read bottom up; None when it is not a right angle
+    x, y = matrix[0], matrix[1]
+    if abs(y) < 1e-6 * abs(x):
+        return "N" if x > 0 else "I"
+    if abs(x) < 1e-6 * abs(y):
+        return "R" if y > 0 else "B"
+    return None
+
+def flatten_curve(start, control1, control2, end):
+    points = []
+    for step in range(1, CURVE_STEPS + 1):
+        t = step / CURVE_STEPS
+        u = 1 - t
+        points.append((u ** 3 * start[0] + 3 * u * u * t * control1[0] + 3 * u * t * t * control2[0] + t ** 3 * end[0],
+                       u ** 3 * start[1] + 3 * u * u * t * control1[1] + 3 * u * t * t * control2[1] + t ** 3 * end[1]))
+    return points
+
+def path_subpaths(path):
+    # [(points, closed), ...] of a reportlab Path, curves flattened
+    subpaths = []
+    points = list(zip(path.points[0::2], path.points[1::2]))
+    position = 0
+    current = None
+    for operator in path.operators:
+        name = shapes._PATH_OP_NAMES[operator]
+        if name == "moveTo":
+            current = [points[position]]
+            subpaths.append([current, False])
+            position += 1
+        elif name == "lineTo":
+            current.append(points[position])
+            position += 1
+        elif name == "curveTo":
+            current.extend(flatten_curve(current[-1], *points[position:position + 3]))
+            position += 3
+        elif name == "closePath" and subpaths:
+            subpaths[-1][1] = True
+    return [(subpath, closed) for subpath, closed in subpaths]
+
+def ellipse_points(cx, cy, rx, ry):
+    return [(cx + rx * math.cos(2 * math.pi * step / ELLIPSE_STEPS), cy + ry * math.sin(2 * math.pi * step / ELLIPSE_STEPS))
+            for step in range(ELLIPSE_STEPS)]
+
+def rounded_rect_points(x, y, width, height, rx, ry):
+    # Quarter ellipses around the corners, counterclockwise from the bottom right
+    points = []
+    steps = ELLIPSE_STEPS // 4
+    for corner, (cx, cy) in enumerate(((x + width - rx, y + ry), (x + width - rx, y + height - ry),
+                                       (x + rx, y + height - ry), (x + rx, y + ry))):
+        for step in range(steps + 1):
+            angle = math.pi / 2 * (corner - 1 + step / steps)
+            points.append((cx + rx * math.cos(angle), cy + ry * math.sin(angle)))
+    return points
+
+def shape_subpaths(node):
+    # Outline of every supported shape as [(points, closed), ...] in the shape's own coordinates
+    if isinstance(node, shapes.Path):
+        return path_subpaths(node)
+    if isinstance(node, shapes.Rect):
+        x, y, width, height = node.x, node.y, node.width, node.height
+        rx = min(node.rx or node.ry or 0, width / 2)
+        ry = min(node.ry or node.rx or 0, height / 2)
+        if rx > 0 and ry > 0:
+            return [(rounded_rect_points(x, y, width, height, rx, ry), True)]
+        return [([(x, y), (x + width, y), (x + width, y + height), (x, y + height)], True)]
+    if isinstance(node, shapes.Circle):
+        return [(ellipse_points(node.cx, node.cy, node.r, node.r), True)]
+    if isinstance(node, shapes.Ellipse):
+        return [(ellipse_points(node.cx, node.cy, node.rx, node.ry), True)]
+    if isinstance(node, shapes.Polygon):
+        return [(list(zip(node.points[0::2], node.points[1::2])), True)]
+    if isinstance(node, shapes.PolyLine):
+        return [(list(zip(node.points[0::2], node.points[1::2])), False)]
+    if isinstance(node, shapes.Line):
+        return [([(node.x1, node.y1), (node.x2, node.y2)], False)]
+    return None
+
+def signed_area(points):
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1])) / 2
+
+def overlapping(polygons):
+    # Whether the bounding boxes of any two polygons share interior; disjoint subpaths fill
+    # the same under either fill rule and can be drawn one by one
+    active = []
+    for left, top, right, bottom in sorted((min(x for x, _ in polygon), min(y for _, y in polygon),
+                                            max(x for x, _ in polygon), max(y for _, y in polygon))
+                                           for polygon in polygons):
+        active = [box for box in active if box[2] > left]
+        if any(box[1] < bottom and top < box[3] for box in active):
+            return True
+        active.append((left, top, right, bottom))
+    return False
+
+def font_file(font_name):
+    # The TrueType or Type 1 file reportlab itself uses for the font, Helvetica when unknown
+    try:
+        face = pdfmetrics.getFont(font_name).face
+    except KeyError:
+        face = pdfmetrics.getFont("Helvetica").face
+    if getattr(face, 'filename', None):
+        return face.filename
+    return face.findT1File()
+
+@functools.lru_cache(maxsize=64)
+def load_font(font_name, size):
+    return ImageFont.truetype(font_file(font_name), size)
+
+def string_width(node):
+    try:
+        return pdfmetrics.stringWidth(node.text, node.fontName, node.fontSize)
+    except KeyError:
+        return pdfmetrics.stringWidth(node.text, "Helvetica", node.fontSize)
+
+def anchor_shift(node):
+    if node.textAnchor == "middle":
+        return string_width(node) / 2
+    if node.textAnchor == "end":
+        return string_width(node)
+    return 0
+
+class Rasterizer:
+    # Draws a reportlab Drawing onto a grayscale page at printer resolution; bitmap() dithers it
+    # to 1 bit. Fills are aliased, so black and white shapes stay solid and only images and gray
+    # fills are dithered. Clipping paths and dash patterns are ignored.
+    def __init__(self, width_pt, height_pt, dpi, base=None):
+        self.scale = dpi / 72
+        self.size = (math.ceil(width_pt * self.scale), math.ceil(height_pt * self.scale))
+        self.image = base.copy() if base is not None else Image.new("L", self.size, WHITE)
+        self.draw = ImageDraw.Draw(self.image)
+        self.draw.fontmode = "1"
+        # PDF user space has y up, the bitmap y down
+        self.matrix = (self.scale, 0, 0, -self.scale, 0, self.size[1])
+
+    def render(self, node, matrix=None, visit=None):
+        # visit(node, matrix) may draw a node some other way and return True to skip it here
+        matrix = self.matrix if matrix is None else matrix
+        if visit is not None and visit(node, matrix):
+            return
+        if isinstance(node, shapes.Group):
+            matrix = shapes.mmult(matrix, node.transform)
+            for child in node.contents:
+                self.render(child, matrix, visit)
+        elif isinstance(node, shapes.String):
+            self.draw_string(node, matrix)
+        elif isinstance(node, shapes.Image):
+            self.draw_image(node, matrix)
+        elif not getattr(node, 'isClipPath', False):
+            subpaths = shape_subpaths(node)
+            if subpaths:
+                self.draw_shape(node, subpaths, matrix)
+
+    def draw_shape(self, node, subpaths, matrix):
+        outlines = [([shapes.transformPoint(matrix, point) for point in points], closed)
+                    for points, closed in subpaths if points]
+        fill = gray_level(getattr(node, 'fillColor', None), getattr(node, 'fillOpacity', 1))
+        polygons = [points for points, _ in outlines if len(points) > 2]
+        if fill is not None and polygons:
+            if not overlapping(polygons):
+                for polygon in polygons:
+                    self.draw.polygon(polygon, fill=fill)
+            else:
+                self.image.paste(fill, (0, 0) + self.size, self.fill_mask(polygons, getattr(node, 'fillMode', None)))
+
+        stroke = gray_level(getattr(node, 'strokeColor', None), getattr(node, 'strokeOpacity', 1))
+        width = (getattr(node, 'strokeWidth', 0) or 0) * matrix_scale(matrix)
+        if stroke is not None and width > 0:
+            for points, closed in outlines:
+                self.draw.line(points + points[:1] if closed else points, fill=stroke,
+                               width=max(1, round(width)), joint="curve")
+
+    def fill_mask(self, polygons, fill_mode):
+        mask = Image.new("1", self.size, 0)
+        if fill_mode == shapes.FILL_EVEN_ODD:
+            for polygon in polygons:
+                outline = Image.new("1", self.size, 0)
+                ImageDraw.Draw(outline).polygon(polygon, fill=1)
+                mask = ImageChops.logical_xor(mask, outline)
+            return mask
+        # Non-zero winding, as outlines and holes wound in opposite directions
+        areas = [signed_area(polygon) for polygon in polygons]
+        outer = math.copysign(1, max(areas, key=abs))
+        draw = ImageDraw.Draw(mask)
+        for polygon, area in zip(polygons, areas):
+            if area * outer >= 0:
+                draw.polygon(polygon, fill=1)
+        for polygon, area in zip(polygons, areas):
+            if area * outer < 0:
+                draw.polygon(polygon, fill=0)
+        return mask
+
+    def paste_mapped(self, source, mask, mapping, fill=None):
+        # mapping takes source pixels to page pixels; whole pixel translations are pasted as is
+        a, b, c, d, e, f = mapping
+        if abs(a - 1) < 1e-6 and abs(d - 1) < 1e-6 and abs(b) < 1e-6 and abs(c) < 1e-6:
+            box = (round(e), round(f))
+        else:
+            inverse = matrix_inverse(mapping)
+            data = (inverse[0], inverse[2], inverse[4], inverse[1], inverse[3], inverse[5])
+            if source is not None:
+                source = source.transform(self.size, Image.AFFINE, data, resample=Image.BILINEAR, fillcolor=WHITE)
+            mask = mask.transform(self.size, Image.AFFINE, data, resample=Image.NEAREST)
+            box = (0, 0)
+        if source is None:
+            self.image.paste(fill, box + (box[0] + mask.width, box[1] + mask.height), mask)
+        else:
+            self.image.paste(source, box, mask)
+
+    def draw_string(self, node, matrix):
+        fill = gray_level(node.fillColor, getattr(node, 'fillOpacity', 1))
+        if fill is None or not node.text:
+            return
+        scale = matrix_scale(matrix)
+        font = load_font(node.fontName, max(1, round(node.fontSize * scale)))
+        left, top, right, bottom = font.getbbox(node.text, anchor="ls")
+        mask = Image.new("L", (right - left + 2, bottom - top + 2), 0)
+        draw = ImageDraw.Draw(mask)
+        draw.fontmode = "1"
+        origin_x, origin_y = 1 - left, 1 - top
+        draw.text((origin_x, origin_y), node.text, fill=255, font=font, anchor="ls")
+        # Mask pixels -> text space, baseline at the string's x, y
+        mapping = (1 / scale, 0, 0, -1 / scale, node.x - anchor_shift(node) - origin_x / scale, node.y + origin_y / scale)
+        self.paste_mapped(None, mask, shapes.mmult(matrix, mapping), fill)
+
+    def draw_image(self, node, matrix):
+        image = node.path if isinstance(node.path, Image.Image) else Image.open(node.path)
+        if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+            image = image.convert("RGBA")
+            mask = image.getchannel("A")
+        else:
+            mask = Image.new("L", image.size, 255)
+        gray = image.convert("L")
+        # Image pixels -> user space, top row at y + height like reportlab draws it
+        mapping = shapes.mmult(matrix, (node.width / image.width, 0, 0, -node.height / image.height,
+                                        node.x, node.y + node.height))
+        a, b, c, d, e, f = mapping
+        if abs(b) < 1e-6 and abs(c) < 1e-6 and a > 0 and d > 0:
+            # Upright images are resampled once to their size on the page
+            size = (max(1, round(image.width * a)), max(1, round(image.height * d)))
+            gray = gray.resize(size, Image.LANCZOS)
+            mask = mask.resize(size, Image.NEAREST)
+            mapping = (1, 0, 0, 1, e, f)
+        self.paste_mapped(gray, mask, mapping)
+
+    def bitmap(self):
+        return self.image.convert("1")
+
+def rasterize(drawing, dpi, base=None):
+    # Grayscale page of the drawing; base is a page to draw over, e.g. the template background
+    rasterizer = Rasterizer(drawing.width, drawing.height, dpi, base)
+    rasterizer.render(drawing)
+    return rasterizer.image
+
+def pbm_bytes(image):
+    # Packed 1-bit raster (binary PBM, 1 is black), rows padded to whole bytes
+    buffer = BytesIO()
+    image.convert("1").save(buffer, format="PPM")
+    return buffer.getvalue()
+
+def zpl_escape(text):
+    # Field data goes through ^FH_, so ^, ~ and _ itself are sent as hex escapes
+    return str(text).replace("_", "_5F").replace("^", "_5E").replace("~", "_7E")
+
+# Code 128 start and code set switches as ^BC invocation codes, by code value and current set
+CODE128_STARTS = {103: ("A", ">9"), 104: ("B", ">:"), 105: ("C", ">;")}
+CODE128_SWITCHES = {"A": {99: ("C", ">5"), 100: ("B", ">6")},
+                    "B": {99: ("C", ">5"), 101: ("A", ">7")},
+                    "C": {100: ("B", ">6"), 101: ("A", ">7")}}
+
+def code128_field_data(payload):
+    # The code sets python-barcode chose for the slot, spelled out for ^BC: the printer's own
+    # choice (e.g. subset B for digits) can be a lot wider than the module count it was sized for
+    import barcode
+    encoded = barcode.get('code128', payload).encoded
+    code_set, data = CODE128_STARTS[encoded[0]]
+    for value in encoded[1:]:
+        if value in CODE128_SWITCHES[code_set]:
+            code_set, invocation = CODE128_SWITCHES[code_set][value]
+            data += invocation
+        elif code_set == "C":
+            data += f"{value:02d}"
+        elif code_set == "A" and value >= 64:
+            # Control characters, sent hex escaped
+            data += f"_{value - 64:02X}"
+        else:
+            # ">" starts an invocation code in ^BC data, "><" is a literal one
+            data += zpl_escape(chr(value + 32)).replace(">", "><")
+    return data
+
+def zpl_repeat(count, character):
+    prefix = "z" * (count // 400)
+    count %= 400
+    if count >= 20:
+        prefix += ZPL_REPEAT_TWENTIES[count // 20 - 1]
+        count %= 20
+    if count:
+        prefix += ZPL_REPEAT_UNITS[count - 1]
+    return prefix + character
+
+def compress_zpl_row(row_hex):
+    # ZPL alternative compression: runs as repeat counts, a trailing run of 0 as ","
+    stripped = row_hex.rstrip("0")
+    parts = []
+    for character, run in itertools.groupby(stripped):
+        length = len(list(run))
+        parts.append(zpl_repeat(length, character) if length > 2 else character * length)
+    if len(stripped) < len(row_hex):
+        parts.append(",")
+    return "".join(parts)
+
+def graphic_field(image, x, y):
+    # ^GF of a grayscale image at x, y in dots, dithered to 1 bit; identical rows repeat as ":"
+    width = (image.width + 7) // 8 * 8
+    padded = Image.new("L", (width, image.height), WHITE)
+    padded.paste(image, (0, 0))
+    bits = padded.convert("1").tobytes().translate(INVERT_BITS)
+    row_bytes = width // 8
+    rows = []
+    previous = None
+    for offset in range(0, len(bits), row_bytes):
+        row = bits[offset:offset + row_bytes]
+        rows.append(":" if row == previous else compress_zpl_row(row.hex().upper()))
+        previous = row
+    return f"^FO{x},{y}^GFA,{len(bits)},{len(bits)},{row_bytes},{''.join(rows)}^FS"
+
+class ZplFields:
+    # Turns a Drawing into ZPL fields. Strings become ^A0 scalable font fields, solid axis
+    # aligned rectangles ^GB boxes and the groups named in symbols native ^BC Code 128 or ^BX
+    # Data Matrix symbols; everything else is rasterized into one graphic field.
+    # symbols: svgid -> (symbology, payload, (columns, rows) of modules)
+    def __init__(self, width_pt, height_pt, dpi, symbols=None):
+        self.rasterizer = Rasterizer(width_pt, height_pt, dpi)
+        self.symbols = symbols or {}
+        self.fields = []
+
+    def add(self, drawing):
+        self.rasterizer.render(drawing, visit=self.visit)
+        return self
+
+    def visit(self, node, matrix):
+        if isinstance(node, shapes.Group):
+            entry = self.symbols.get(getattr(node, 'svgid', None))
+            return entry is not None and self.symbol_field(node, matrix, *entry)
+        if isinstance(node, shapes.String):
+            return self.text_field(node, matrix)
+        if isinstance(node, shapes.Rect):
+            return self.box_field(node, matrix)
+        return False
+
+    def text_field(self, node, matrix):
+        fill = gray_level(node.fillColor, getattr(node, 'fillOpacity', 1))
+        if fill is None or not node.text:
+            return True
+        field_orientation = orientation(matrix)
+        if field_orientation is None or BLACK_BELOW <= fill <= WHITE_ABOVE:
+            return False
+        height = max(1, round(node.fontSize * matrix_scale(matrix)))
+        x, y = shapes.transformPoint(matrix, (node.x - anchor_shift(node), node.y))
+        # White text is printed reversed over whatever was drawn below it
+        reverse = "^FR" if fill > WHITE_ABOVE else ""
+        self.fields.append(f"^FT{round(x)},{round(y)}^A0{field_orientation},{height},{height}{reverse}"
+                           f"^FH_^FD{zpl_escape(node.text)}^FS")
+        return True
+
+    def box_field(self, node, matrix):
+        if orientation(matrix) is None:
+            return False
+        fill = gray_level(node.fillColor, getattr(node, 'fillOpacity', 1))
+        stroke = gray_level(node.strokeColor, getattr(node, 'strokeOpacity', 1))
+        if any(level is not None and BLACK_BELOW <= level <= WHITE_ABOVE for level in (fill, stroke)):
+            return False
+        corners = [shapes.transformPoint(matrix, point) for point in
+                   ((node.x, node.y), (node.x + node.width, node.y + node.height))]
+        left, right = sorted(x for x, _ in corners)
+        top, bottom = sorted(y for _, y in corners)
+        scale = matrix_scale(matrix)
+        radius = max(node.rx or 0, node.ry or 0) * scale
+        if fill is not None:
+            self.add_box(left, top, right - left, bottom - top, None, fill, radius)
+        thickness = (node.strokeWidth or 0) * scale
+        if stroke is not None and thickness > 0:
+            # SVG strokes straddle the outline, ^GB borders lie inside the box
+            self.add_box(left - thickness / 2, top - thickness / 2, right - left + thickness,
+                         bottom - top + thickness, thickness, stroke, radius)
+        return True
+
+    def add_box(self, x, y, width, height, thickness, level, radius):
+        width, height = max(1, round(width)), max(1, round(height))
+        thickness = min(width, height) if thickness is None else max(1, round(thickness))
+        rounding = min(8, round(8 * radius / (min(width, height) / 2))) if radius else 0
+        color = "W" if level > WHITE_ABOVE else "B"
+        self.fields.append(f"^FO{round(x)},{round(y)}^GB{width},{height},{thickness},{color},{rounding}^FS")
+
+    def symbol_field(self, node, matrix, symbology, payload, modules):
+        field_orientation = orientation(shapes.mmult(matrix, node.transform))
+        bounds = node.getBounds()
+        if field_orientation is None or bounds is None:
+            return False
+        corners = [shapes.transformPoint(matrix, point) for point in ((bounds[0], bounds[1]), (bounds[2], bounds[3]))]
+        left, right = sorted(x for x, _ in corners)
+        top, bottom = sorted(y for _, y in corners)
+        along, across = right - left, bottom - top
+        if field_orientation in ("R", "B"):
+            along, across = across, along
+        columns, rows = modules
+        if symbology == "datamatrix":
+            module = max(1, math.floor(min(along / columns, across / rows)))
+            self.fields.append(f"^FO{round(left)},{round(top)}^BX{field_orientation},{module},200,{columns},{rows}"
+                               f"^FH_^FD{zpl_escape(payload)}^FS")
+        else:
+            module = max(1, round(along / columns))
+            self.fields.append(f"^FO{round(left)},{round(top)}^BY{module}^BC{field_orientation},{max(1, round(across))},N,N,N"
+                               f"^FH_^FD{code128_field_data(payload)}^FS")
+        return True
+
+    def commands(self):
+        # The bitmap goes first, text and boxes are drawn over it like in the drawing
+        image = self.rasterizer.image
+        box = ImageOps.invert(image).getbbox()
+        graphic = [graphic_field(image.crop(box), box[0], box[1])] if box else []
+        return "".join(graphic + self.fields)
+
+def zpl_fields(drawing, dpi, symbols=None):
+    return ZplFields(drawing.width, drawing.height, dpi, symbols).add(drawing).commands()
+
+def zpl_label(width_pt, height_pt, dpi, fields):
+    # One label: print width and length in dots, UTF-8 field data, then the fields in order
+    width = math.ceil(width_pt * dpi / 72)
+    height = math.ceil(height_pt * dpi / 72)
+    return f"^XA^CI28^PW{width}^LL{height}^LH0,0{''.join(fields)}^XZ\n".encode('utf-8')
@@ -0,0 +1,184 @@
+import re
+import math
+import zlib
+import base64
+import hashlib
+from io import BytesIO
+from PIL import Image
+from svglib.svglib import SvgRenderer
+from reportlab import rl_config
+from reportlab.pdfbase import pdfdoc
+from reportlab.pdfgen import canvas
+from reportlab.graphics.renderPDF import _PDFRenderer
+from reportlab.graphics.renderbase import renderScaledDrawing
+from metrics import stage, count
+
+# Streams are written binary; ASCII85 would add a quarter to every image and page
+rl_config.useA85 = 0
+
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+# Same embedded formats svglib itself decodes
+DATA_URI = re.compile(r'^data:image/(?:jpe?g|png);base64,')
+# href of a raster extracted from the template at compile time, see app.extract_rasters
+RASTER_SCHEME = "raster:"
+
+def decode_image(data):
+    # Decoded up front so renders on several threads never race on PIL's lazy loading
+    image = Image.open(BytesIO(data))
+    image.load()
+    return image
+
+class LabelRenderer(SvgRenderer):
+    # svglib writes every data: URI image to a temporary file it never deletes, which fills
+    # /tmp on a warm container. Decode them in memory instead, and look up the template's
+    # extracted rasters by name; reportlab draws PIL images directly.
+    def __init__(self, path, rasters=None):
+        super().__init__(path)
+        self.rasters = rasters
+
+    def xlink_href_target(self, node, group=None):
+        href = node.attrib.get(XLINK_HREF) or node.attrib.get('href') or ""
+        if href.startswith(RASTER_SCHEME) and self.rasters is not None:
+            return self.rasters.image(href[len(RASTER_SCHEME):])
+        match = DATA_URI.match(href)
+        if match:
+            return decode_image(base64.b64decode(href[match.end():]))
+        return super().xlink_href_target(node, group)
+
+# Colour spaces of the image modes written as is, everything else is converted to RGB
+IMAGE_COLOR_SPACES = {"L": "DeviceGray", "RGB": "DeviceRGB", "CMYK": "DeviceCMYK"}
+# Images with at most this many colours (line art, logos, barcodes) are always kept lossless
+FLATE_MAX_COLORS = 256
+
+def pdf_canvas(target, pagesize=None):
+    # Every PDF is started here, after the output settings above are in place
+    if pagesize is None:
+        return canvas.Canvas(target)
+    return canvas.Canvas(target, pagesize=pagesize)
+
+def image_digest(image):
+    # Template rasters are drawn by every label, their digest is computed once per image object
+    # (PIL images are not hashable, so it is kept on the image itself)
+    digest = getattr(image, '_pdf_digest', None)
+    if digest is None:
+        digest = hashlib.sha256(f"{image.mode}:{image.size}".encode('ascii') + image.tobytes()).hexdigest()
+        image._pdf_digest = digest
+    return digest
+
+class EncodedImage:
+    # Compressed pixel data of a PDF image XObject, cached across documents
+    def __init__(self, width, height, color_space, filters, data):
+        self.width = width
+        self.height = height
+        self.color_space = color_space
+        self.filters = filters
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def xobject(self, name):
+        image = pdfdoc.PDFImageXObject(name)
+        image.width = self.width
+        image.height = self.height
+        image.colorSpace = self.color_space
+        image.bitsPerComponent = 8
+        image._filters = self.filters
+        image.streamContent = self.data
+        return image
+
+def encode_image(image, jpeg_quality):
+    # Flate for few-colour images, otherwise DCT unless Flate happens to be smaller
+    if image.mode not in IMAGE_COLOR_SPACES:
+        image = image.convert("RGB")
+    flate = zlib.compress(image.tobytes(), 9)
+    filters = ("FlateDecode",)
+    # Deflate caps matches at 258 bytes, so large flat areas leave a repetitive stream that a
+    # second pass shrinks again (inline images used to get that from the page compression)
+    twice = zlib.compress(flate, 9)
+    if len(twice) < len(flate):
+        flate, filters = twice, ("FlateDecode", "FlateDecode")
+    encoded = EncodedImage(image.width, image.height, IMAGE_COLOR_SPACES[image.mode], filters, flate)
+    if image.mode == "CMYK" or not jpeg_quality or image.getcolors(FLATE_MAX_COLORS) is not None:
+        return encoded
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=jpeg_quality, optimize=True)
+    if buffer.tell() < len(flate):
+        encoded = EncodedImage(image.width, image.height, encoded.color_space, ("DCTDecode",), buffer.getvalue())
+    return encoded
+
+class ImageOptimizer:
+    # Prepares every image of a PDF: downsampled to its size on the page at dpi, encoded once
+    # per content, size and quality (cache shared by all documents), and drawn as an image
+    # XObject named after that key, so identical images are stored once per document.
+    def __init__(self, dpi, jpeg_quality, cache):
+        self.dpi = dpi
+        self.jpeg_quality = jpeg_quality
+        self.cache = cache
+        self.images_drawn = 0
+
+    def target_size(self, image, width_pt, height_pt):
+        if not self.dpi:
+            return image.size
+        return (max(1, min(image.width, math.ceil(abs(width_pt) / 72 * self.dpi))),
+                max(1, min(image.height, math.ceil(abs(height_pt) / 72 * self.dpi))))
+
+    def encoded(self, image, size):
+        key = f"{image_digest(image)}:{size[0]}x{size[1]}:{self.jpeg_quality}"
+        encoded = self.cache.get(key)
+        if encoded is None:
+            count("pdf_image_cache_miss")
+            with stage("image_encode"):
+                resized = image if image.size == size else image.resize(size, Image.LANCZOS)
+                encoded = encode_image(resized, self.jpeg_quality)
+            self.cache.put(key, encoded)
+        else:
+            count("pdf_image_cache_hit")
+        return key, encoded
+
+    def draw(self, c, image, x, y, width, height, width_pt, height_pt):
+        # Same XObject registration as canvas.drawImage, but keyed by the encoded image so the
+        # pixels are neither compressed nor hashed again for every use
+        self.images_drawn += 1
+        key, encoded = self.encoded(image, self.target_size(image, width_pt, height_pt))
+        name = hashlib.sha1(key.encode('ascii')).hexdigest()[:16]
+        registered_name = c._doc.getXObjectName(name)
+        if c._doc.idToObject.get(registered_name) is None:
+            xobject = encoded.xobject(name)
+            c._setXObjects(xobject)
+            c._doc.Reference(xobject, registered_name)
+            c._doc.addForm(name, xobject)
+        c.saveState()
+        c.translate(x, y)
+        c.scale(width, height)
+        c._code.append(f"/{registered_name} Do")
+        c.restoreState()
+        # Lists it in the resources of the page or form being drawn
+        c._formsinuse.append(name)
+        c._currentPageHasImages = 1
+
+class LabelPdfRenderer(_PDFRenderer):
+    # renderPDF writes every image inline, so each use stores (and compresses) its pixels again;
+    # here they go through the ImageOptimizer instead
+    def __init__(self, optimizer):
+        super().__init__()
+        self.optimizer = optimizer
+
+    def drawImage(self, image):
+        source = image.path
+        if isinstance(source, str):
+            try:
+                source = Image.open(source)
+            except OSError:
+                return
+        elif not hasattr(source, 'mode'):
+            return
+        # Size on the page, for downsampling
+        a, b, c, d, _, _ = self._tracker.getCTM()
+        width_pt = image.width * math.hypot(a, b)
+        height_pt = image.height * math.hypot(c, d)
+        self.optimizer.draw(self._canvas, source, image.x, image.y, image.width, image.height, width_pt, height_pt)
+
+def draw_drawing(drawing, c, x, y, optimizer):
+    # renderPDF.draw with LabelPdfRenderer
+    LabelPdfRenderer(optimizer).draw(renderScaledDrawing(drawing), c, x, y)
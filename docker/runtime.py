@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import sys
+import os
+import json
+import time
+import traceback
+import importlib
+import http.client
+
+RUNTIME_API_VERSION = "2018-06-01"
+
+class RuntimeClient:
+    # One keep-alive connection to the local Runtime API. http.client is enough for it and keeps
+    # requests out of the runtime, so only the handler decides what gets imported.
+    def __init__(self, address):
+        self.connection = http.client.HTTPConnection(address)
+
+    def request(self, method, path, body=None, headers=None):
+        self.connection.request(method, f"/{RUNTIME_API_VERSION}/runtime/{path}", body=body, headers=headers or {})
+        response = self.connection.getresponse()
+        # Read to the end so the connection can carry the next request
+        return response, response.read()
+
+    def get(self, path):
+        return self.request("GET", path)
+
+    def post(self, path, data, headers=None):
+        return self.request("POST", path, data.encode("utf-8"), headers)
+
+class LambdaContext:
+    # Minimal stand-in for the context object the managed Python runtime passes to handlers
+    def __init__(self, headers):
+        self.aws_request_id = headers.get("Lambda-Runtime-Aws-Request-Id")
+        self.invoked_function_arn = headers.get("Lambda-Runtime-Invoked-Function-Arn")
+        self.deadline_ms = int(headers.get("Lambda-Runtime-Deadline-Ms", 0))
+        self.function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+        self.function_version = os.environ.get("AWS_LAMBDA_FUNCTION_VERSION")
+        self.memory_limit_in_mb = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+        self.log_group_name = os.environ.get("AWS_LAMBDA_LOG_GROUP_NAME")
+        self.log_stream_name = os.environ.get("AWS_LAMBDA_LOG_STREAM_NAME")
+
+    def get_remaining_time_in_millis(self):
+        return max(self.deadline_ms - int(time.time() * 1000), 0)
+
+def error_payload(error):
+    return {
+        'errorMessage': str(error),
+        'errorType': type(error).__name__,
+        'stackTrace': traceback.format_exception(type(error), error, error.__traceback__)
+    }
+
+def load_handler(handler_name):
+    # Handler is given as 'module.function', the same format as the Lambda CMD
+    module_name, function_name = handler_name.rsplit(".", 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+def run(handler_name):
+    session = RuntimeClient(os.environ["AWS_LAMBDA_RUNTIME_API"])
+
+    # Import the handler once; reportlab, svglib, boto3 etc. stay loaded between invocations
+    try:
+        handler = load_handler(handler_name)
+    except Exception as e:
+        session.post("init/error", data=json.dumps(error_payload(e)),
+                     headers={'Lambda-Runtime-Function-Error-Type': 'Runtime.ImportModuleError'})
+        raise
+
+    while True:
+        # Long poll for the next event, no timeout
+        response, body = session.get("invocation/next")
+        if response.status != 200:
+            raise RuntimeError(f"Runtime API returned {response.status} for the next invocation")
+        request_id = response.headers["Lambda-Runtime-Aws-Request-Id"]
+        trace_id = response.headers.get("Lambda-Runtime-Trace-Id")
+        if trace_id:
+            os.environ["_X_AMZN_TRACE_ID"] = trace_id
+
+        try:
+            event = json.loads(body)
+            result = json.dumps(handler(event, LambdaContext(response.headers)))
+        except Exception as e:
+            traceback.print_exc()
+            session.post(f"invocation/{request_id}/error", data=json.dumps(error_payload(e)),
+                         headers={'Lambda-Runtime-Function-Error-Type': 'Unhandled'})
+            continue
+
+        session.post(f"invocation/{request_id}/response", data=result)
+
+if __name__ == "__main__":
+    run(sys.argv[1] if len(sys.argv) > 1 else "app.lambda_handler")
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import threading
+import traceback
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Imported before forking; serve() also preloads reportlab, svglib, boto3 etc. so workers share them
+import app
+
+SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", 8080))
+# Worker processes, and renders each worker runs at once before answering 503
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", os.cpu_count() or 1))
+SERVER_CONCURRENCY = int(os.environ.get("SERVER_CONCURRENCY", 2))
+SERVER_MAX_BODY = int(os.environ.get("SERVER_MAX_BODY", 10 * 1024 * 1024))
+
+class RenderServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, listen_socket, concurrency):
+        super().__init__(listen_socket.getsockname(), RenderRequestHandler, bind_and_activate=False)
+        # All workers accept on the socket the parent bound; the one TCPServer created is unused
+        self.socket.close()
+        self.socket = listen_socket
+        self.concurrency = concurrency
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.in_flight = 0
+        self.served = 0
+        self.rejected = 0
+        self.started = time.time()
+        self.counter_lock = threading.Lock()
+
+    def server_bind(self):
+        pass
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    # POST /render  event JSON -> the label (PDF, ZPL or PBM per output_format, nothing uploaded)
+    # POST /invoke  event JSON -> lambda_handler response (uploads, batches, SQS events)
+    # GET  /health  worker status and cache statistics
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"[worker {os.getpid()}] {self.address_string()} {format % args}\n")
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 503:
+            self.send_header("Retry-After", "1")
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload):
+        self.send_body(status, json.dumps(payload).encode('utf-8'), "application/json")
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {'errorMessage': f"Unknown path {self.path}"})
+            return
+        server = self.server
+        self.send_json(200, {
+            'status': 'ok',
+            'pid': os.getpid(),
+            'uptime': round(time.time() - server.started, 1),
+            'in_flight': server.in_flight,
+            'concurrency': server.concurrency,
+            'served': server.served,
+            'rejected': server.rejected,
+            'templates': len(app._template_cache),
+            'symbols': app._symbol_cache.stats(),
+        })
+
+    def reject_unread(self, status, message):
+        # The body stays unread, so the connection cannot carry another request after it
+        self.close_connection = True
+        self.send_json(status, {'errorMessage': message})
+
+    def do_POST(self):
+        if self.path not in ("/render", "/invoke"):
+            self.reject_unread(404, f"Unknown path {self.path}")
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.reject_unread(400, "Invalid Content-Length")
+            return
+        if length > SERVER_MAX_BODY:
+            self.reject_unread(413, f"Body larger than {SERVER_MAX_BODY} bytes")
+            return
+
+        # Backpressure: refuse instead of queueing once this worker is saturated, so the load
+        # balancer can send the request to another host. Checked before the body is read, a
+        # busy worker does not take in large payloads it will not render.
+        server = self.server
+        if not server.slots.acquire(blocking=False):
+            with server.counter_lock:
+                server.rejected += 1
+            self.reject_unread(503, "Worker busy")
+            return
+        with server.counter_lock:
+            server.in_flight += 1
+        try:
+            self.handle_event(self.rfile.read(length))
+        finally:
+            with server.counter_lock:
+                server.in_flight -= 1
+                server.served += 1
+            server.slots.release()
+
+    def handle_event(self, body):
+        try:
+            event = json.loads(body)
+        except ValueError as e:
+            self.send_json(400, {'errorMessage': f"Invalid JSON: {e}", 'errorType': type(e).__name__})
+            return
+
+        try:
+            if self.path == "/render":
+                label_bytes = app.render_label(event)
+                content_type = app.OUTPUT_FORMATS[app.label_output_format(event)][1]
+            else:
+                response = app.lambda_handler(event, None)
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, {'errorMessage': str(e), 'errorType': type(e).__name__})
+            return
+
+        if self.path == "/render":
+            self.send_body(200, label_bytes, content_type)
+        else:
+            self.send_json(200, response)
+
+def run_worker(listen_socket, concurrency):
+    # Fill caches and initialise native libraries before taking traffic
+    app.warm_worker()
+    signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+    RenderServer(listen_socket, concurrency).serve_forever()
+
+def spawn_worker(listen_socket, concurrency):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(listen_socket, concurrency)
+        finally:
+            os._exit(1)
+    return pid
+
+def serve(host, port, workers, concurrency):
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((host, port))
+    listen_socket.listen(workers * concurrency * 4)
+    print(f"Serving on {host}:{port} with {workers} workers x {concurrency} renders")
+
+    # app imports its heavy modules lazily, load them once here before forking
+    app.preload_modules()
+
+    children = {spawn_worker(listen_socket, concurrency) for _ in range(workers)}
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Replace workers that die so the pool stays at full size
+    while True:
+        pid, status = os.wait()
+        children.discard(pid)
+        print(f"Worker {pid} exited with status {status}, restarting")
+        children.add(spawn_worker(listen_socket, concurrency))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render labels over HTTP with a pre-forked worker pool")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    parser.add_argument("--concurrency", type=int, default=SERVER_CONCURRENCY)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.concurrency)